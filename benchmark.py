@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Benchmarks for the model layer and image pipeline, on synthetic scan libraries.
+
+Runs without a display. Prints JSON results, which can be saved with --output
+and compared against an earlier run with --compare.
+"""
+import argparse
+import importlib.machinery
+import importlib.util
+import json
+import pathlib
+import platform
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+import frontmatter
+import PIL.Image
+import PIL.ImageDraw
+
+import ui
+
+HERE = pathlib.Path(__file__).resolve().parent
+PIPELINE = ["cleaned", "categorized", "named", "hand_transcribe", "transcribed", "verified"]
+WORDS = "the of and receipt total invoice paid dear thanks meeting note list milk eggs call".split()
+
+
+def load_scan_organizer():
+    """Import the scan-organizer script, which has no .py extension"""
+    loader = importlib.machinery.SourceFileLoader("scan_organizer", str(HERE.joinpath("scan-organizer")))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def generate_library(root, images, size, depth, fanout, transcription_words, seed, tag_mix=None):
+    """Make a fake scan folder: nested categories, images at every stage of the pipeline.
+
+    tag_mix weighs how many images have reached each stage (none, then each of PIPELINE).
+    """
+    rng = random.Random(seed)
+    categories = [root.joinpath("unsorted")]
+    level = [root]
+    for d in range(depth):
+        level = [parent.joinpath("category{}-{}".format(d, i)) for parent in level for i in range(fanout)]
+        categories.extend(level)
+    for category in categories:
+        category.mkdir(parents=True, exist_ok=True)
+
+    # Encoding is the slow part, so every image is a copy of one of a few templates
+    templates = []
+    for i in range(4):
+        img = PIL.Image.effect_noise(size, 40 + i*10).convert("RGB")
+        template = root.joinpath("template{}.jpg".format(i))
+        img.save(template)
+        templates.append(template)
+    for i in range(images):
+        category = rng.choice(categories)
+        image_path = category.joinpath("scan{:06d}.jpg".format(i))
+        shutil.copyfile(rng.choice(templates), image_path)
+        tags = PIPELINE[:rng.choices(range(len(PIPELINE) + 1), weights=tag_mix)[0]]
+        if len(tags) > 0:
+            post = frontmatter.Post(" ".join(rng.choice(WORDS) for _ in range(transcription_words)) if "transcribed" in tags else "")
+            post['tags'] = tags
+            post['filename'] = image_path.name
+            frontmatter.dump(post, image_path.with_suffix(".txt"))
+    for template in templates:
+        template.unlink()
+
+
+def generate_large_images(root, count, size):
+    paths = []
+    for i in range(count):
+        img = PIL.Image.new("L", size, 255)
+        draw = PIL.ImageDraw.Draw(img)
+        for y in range(0, size[1], 40): # Lines of "text"
+            draw.line([(size[0]//10, y), (size[0]*9//10, y)], fill=0, width=8)
+        path = root.joinpath("large{}.png".format(i))
+        img.convert("RGB").save(path)
+        paths.append(path)
+    return paths
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def cold_start(scan_organizer, library):
+    organizer = scan_organizer.ScanOrganizer(library, window=ui.HeadlessWindow())
+    organizer.load_master(library)
+    return organizer
+
+
+def navigation_sweep(organizer):
+    for phase, _, _, _, work_images in organizer.phases():
+        for _ in range(len(work_images)):
+            organizer.next_work(phase, None)
+
+
+def bulk_tag(organizer):
+    """Finish every Phase 1 image, moving it on to Phase 2, then put them all back"""
+    phase, _, _, _, work_images = next(organizer.phases())
+    indices = list(work_images)
+    for index in indices:
+        organizer._tag("+cleaned", phase, organizer.images[index])
+    for index in indices:
+        organizer._tag("-cleaned", phase, organizer.images[index])
+
+
+def category_rename(organizer):
+    """Rename the biggest category and rename it back. Times only the foreground part"""
+    def images_within(category):
+        return sum(len(organizer._category_images[c]) for c in organizer.categories if c.is_within(category))
+    category = max((c for c in organizer.categories if c.parent is None), key=images_within)
+    old_name = category.name
+    elapsed = timed(organizer.on_rename_category, category, old_name + "-renamed")
+    elapsed += timed(organizer.on_rename_category, category, old_name)
+    for thread in organizer._background_threads:
+        thread.join()
+    return elapsed
+
+
+def image_fit(paths, width, height):
+    """Show each image fitted to the screen"""
+    for path in paths:
+        pyramid = ui.TilePyramid(ui.open_page(path, 0))
+        scale = min(width / pyramid.size[0], height / pyramid.size[1])
+        for level, tx, ty, _, _, tile_width, tile_height in pyramid.visible_tiles(scale, 0, 0, width, height):
+            pyramid.tile(level, tx, ty, tile_width, tile_height)
+
+
+def image_pan(paths, width, height):
+    """Pan down the middle of each image at full size, a screen at a time"""
+    for path in paths:
+        pyramid = ui.TilePyramid(ui.open_page(path, 0))
+        left = max(0, pyramid.size[0] // 2 - width // 2)
+        for top in range(0, pyramid.size[1], height):
+            for level, tx, ty, _, _, tile_width, tile_height in pyramid.visible_tiles(1, left, top, width, height):
+                pyramid.tile(level, tx, ty, tile_width, tile_height)
+
+
+def run(args):
+    scan_organizer = load_scan_organizer()
+    root = pathlib.Path(tempfile.mkdtemp(prefix="scan-organizer-benchmark-"))
+    try:
+        pristine = root.joinpath("pristine")
+        pristine.mkdir()
+        generate_library(pristine, args.images, args.size, args.depth, args.fanout, args.transcription_words, args.seed, args.tag_mix)
+        library = root.joinpath("library")
+        large = root.joinpath("large")
+        large.mkdir()
+        large_paths = generate_large_images(large, args.large_images, args.large_size)
+
+        results = { name: [] for name in ["cold_start", "warm_start", "navigation_sweep", "bulk_tag", "category_rename", "image_fit", "image_pan"] }
+        for i in range(args.repeat):
+            # Tagging and renaming rewrite sidecars, so every repeat starts from a fresh copy
+            shutil.rmtree(library, ignore_errors=True)
+            shutil.copytree(pristine, library)
+            start = time.perf_counter()
+            organizer = cold_start(scan_organizer, library)
+            # The first load also pays one-off costs in this process, such as loading PIL plugins.
+            # None are cold for the OS cache, which has the library from copying it
+            results["cold_start" if i == 0 else "warm_start"].append(time.perf_counter() - start)
+            results["navigation_sweep"].append(timed(navigation_sweep, organizer))
+            results["bulk_tag"].append(timed(bulk_tag, organizer))
+            results["category_rename"].append(category_rename(organizer))
+            organizer.leases.release_all()
+            results["image_fit"].append(timed(image_fit, large_paths, 1000, 800))
+            results["image_pan"].append(timed(image_pan, large_paths, 1000, 800))
+    finally:
+        shutil.rmtree(root)
+
+    return {
+        "parameters": { k: v for k, v in vars(args).items() if k not in {"output", "compare"} },
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": {
+            name: { "runs": runs, "min": min(runs), "median": statistics.median(runs) }
+            for name, runs in results.items() if len(runs) > 0
+        },
+    }
+
+
+def compare(baseline, current):
+    lines = ["{:<20} {:>12} {:>12} {:>8}".format("Scenario", "Baseline (s)", "Current (s)", "Ratio")]
+    for name, result in current["results"].items():
+        if name in baseline["results"]:
+            old, new = baseline["results"][name]["median"], result["median"]
+            lines.append("{:<20} {:>12.4f} {:>12.4f} {:>8.2f}".format(name, old, new, new / old if old > 0 else float("inf")))
+    return "\n".join(lines)
+
+
+def tag_mix(text):
+    weights = [float(x) for x in text.split(",")]
+    if len(weights) != len(PIPELINE) + 1:
+        raise argparse.ArgumentTypeError("needs {} weights".format(len(PIPELINE) + 1))
+    return weights
+
+
+def size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=2000)
+    parser.add_argument("--size", type=size, default=(200, 300), help="WIDTHxHEIGHT of library images")
+    parser.add_argument("--depth", type=int, default=2, help="Levels of nested categories")
+    parser.add_argument("--fanout", type=int, default=5, help="Subcategories per category")
+    parser.add_argument("--transcription-words", type=int, default=100)
+    parser.add_argument("--tag-mix", type=tag_mix, help="Comma-separated weights for how many images are at each stage: untouched, then {}".format(", ".join(PIPELINE)))
+    parser.add_argument("--large-images", type=int, default=3)
+    parser.add_argument("--large-size", type=size, default=(5000, 7000), help="WIDTHxHEIGHT of image pipeline images")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=pathlib.Path, help="Save results as JSON")
+    parser.add_argument("--compare", type=pathlib.Path, help="Earlier results to compare against")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print(compare(json.load(f), results))
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""Export the library for use in other tools.
+
+Images are read one at a time (in a process pool), so memory use doesn't grow
+with the library. The export remembers each image's signature (size and mtime
+of the image and its sidecar) and what was exported for it, so exporting again
+only re-reads images which changed, and drops images which are gone.
+
+Formats:
+- sqlite: an `items` table, one row per image
+- jsonl: one JSON object per image
+- html: a static site, with a page and thumbnail per image and a search box
+"""
+import concurrent.futures
+import datetime
+import hashlib
+import html
+import json
+import os
+import sqlite3
+
+import yaml
+
+import ui
+from organize import IMAGE_SUFFIXES, OrganizerImage, file_signature, is_category, walk_library
+
+THUMBNAIL_SIZE = (300, 300)
+IN_FLIGHT = 64 # Images being read at once, per worker
+
+
+def _signature(path):
+    """The image's file_signature, and its sidecar's"""
+    sidecar = path.with_suffix(".txt")
+    signature = file_signature(path)
+    if sidecar.exists():
+        signature += file_signature(sidecar)
+    return signature
+
+
+def _read_item(path, key, category, signature, thumbnail_dir):
+    """Runs in a worker process. Returns (key, signature, record or error message)"""
+    try:
+        image = OrganizerImage(path, None, 0)
+        pages = image.page_transcriptions
+    except (OSError, ValueError, yaml.YAMLError, UnicodeDecodeError) as e:
+        return key, signature, str(e).splitlines()[0]
+    record = {
+        "key": key,
+        "id": hashlib.sha1(key.encode("utf8")).hexdigest()[:16],
+        "filename": path.name,
+        "category": category,
+        "tags": list(image.tags),
+        "transcription": image.transcription,
+        "pages": pages,
+        "metadata": { k: v for k, v in image.textfm.metadata.items() if k not in {"tags", "filename", "category"} },
+        "size": signature[0],
+        "modified": datetime.datetime.fromtimestamp(signature[1] / 1e9).isoformat(timespec="seconds"),
+        "thumbnail": None,
+    }
+    if thumbnail_dir is not None:
+        thumbnail = thumbnail_dir.joinpath(record["id"] + ".jpg")
+        try:
+            img = ui.open_page(path, 0)
+            img.thumbnail(THUMBNAIL_SIZE)
+            img.convert("RGB").save(thumbnail, format="JPEG", quality=80)
+            record["thumbnail"] = thumbnail.name
+        except (OSError, ValueError): # No thumbnail is better than no export
+            pass
+    return key, signature, record
+
+
+def _bounded_map(executor, function, items, limit):
+    """Like executor.map, but only reads ahead limit items, to keep memory use flat"""
+    pending = []
+    for item in items:
+        pending.append(executor.submit(function, *item))
+        if len(pending) >= limit:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+class Exporter():
+    """Writes one export format. The state table lives in the database at state_path"""
+    thumbnails = False
+
+    def __init__(self, master, output):
+        self.master = master
+        self.output = output
+
+    def begin(self, db):
+        pass
+
+    def put(self, record):
+        pass
+
+    def remove(self, record):
+        pass
+
+    def finish(self, db, changed):
+        pass
+
+
+class SqliteExporter(Exporter):
+    @property
+    def state_path(self):
+        return self.output
+
+    def begin(self, db):
+        self.db = db
+        db.execute("""CREATE TABLE IF NOT EXISTS items (
+            key TEXT PRIMARY KEY, filename TEXT, category TEXT, tags TEXT,
+            transcription TEXT, pages TEXT, metadata TEXT, size INTEGER, modified TEXT)""")
+        db.execute("CREATE INDEX IF NOT EXISTS items_category ON items (category)")
+
+    def put(self, record):
+        self.db.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+            record["key"], record["filename"], record["category"], json.dumps(record["tags"]),
+            record["transcription"], json.dumps(record["pages"]), json.dumps(record["metadata"], default=str),
+            record["size"], record["modified"],
+        ))
+
+    def remove(self, record):
+        self.db.execute("DELETE FROM items WHERE key = ?", (record["key"],))
+
+
+class JsonlExporter(Exporter):
+    @property
+    def state_path(self):
+        return self.output.with_name(self.output.name + ".state")
+
+    def finish(self, db, changed):
+        if not changed and self.output.exists():
+            return
+        # Lines can't be replaced in place, so write it all again from the state
+        tmp_path = self.output.with_name(self.output.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            for record, in db.execute("SELECT record FROM export_state ORDER BY key"):
+                f.write(record + "\n")
+        os.replace(tmp_path, self.output)
+
+
+class HtmlExporter(Exporter):
+    thumbnails = True
+
+    @property
+    def state_path(self):
+        return self.output.joinpath("export-state.sqlite")
+
+    @property
+    def thumbnail_dir(self):
+        return self.output.joinpath("thumbnails")
+
+    def begin(self, db):
+        os.makedirs(self.output.joinpath("items"), exist_ok=True)
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+
+    def _item_path(self, record):
+        return self.output.joinpath("items", record["id"] + ".html")
+
+    def put(self, record):
+        image = os.path.relpath(self.master.joinpath(record["key"]), self.output.joinpath("items"))
+        parts = ["<!DOCTYPE html>", "<meta charset=\"utf-8\">", "<title>{}</title>".format(html.escape(record["filename"])),
+                 "<p><a href=\"../index.html\">All scans</a></p>",
+                 "<h1>{}</h1>".format(html.escape(record["filename"])),
+                 "<p>Category: {}<br>Tags: {}</p>".format(html.escape(record["category"] or "(none)"), html.escape(", ".join(record["tags"])))]
+        if record["thumbnail"] is not None:
+            parts.append("<p><a href=\"{}\"><img src=\"../thumbnails/{}\"></a></p>".format(html.escape(image), record["thumbnail"]))
+        else:
+            parts.append("<p><a href=\"{}\">Image</a></p>".format(html.escape(image)))
+        for i, page in enumerate(record["pages"]):
+            if len(record["pages"]) > 1:
+                parts.append("<h2>Page {}</h2>".format(i + 1))
+            parts.append("<pre>{}</pre>".format(html.escape(page)))
+        with open(self._item_path(record), "w") as f:
+            f.write("\n".join(parts) + "\n")
+
+    def remove(self, record):
+        self._item_path(record).unlink(missing_ok=True)
+        if record["thumbnail"] is not None:
+            self.thumbnail_dir.joinpath(record["thumbnail"]).unlink(missing_ok=True)
+
+    def finish(self, db, changed):
+        with open(self.output.joinpath("index.html"), "w") as f:
+            f.write(INDEX_HTML)
+        if not changed and self.output.joinpath("search.js").exists():
+            return
+        tmp_path = self.output.joinpath("search.js.tmp")
+        with open(tmp_path, "w") as f:
+            f.write("var ITEMS = [\n")
+            for record, in db.execute("SELECT record FROM export_state ORDER BY key"):
+                record = json.loads(record)
+                f.write(json.dumps({
+                    "id": record["id"], "filename": record["filename"], "category": record["category"],
+                    "tags": record["tags"], "thumbnail": record["thumbnail"], "text": record["transcription"],
+                }) + ",\n")
+            f.write("];\n")
+        os.replace(tmp_path, self.output.joinpath("search.js"))
+
+
+INDEX_HTML = """<!DOCTYPE html>
+<meta charset="utf-8">
+<title>Scans</title>
+<style>
+  .item { display: inline-block; width: 160px; margin: 4px; vertical-align: top; font-size: small; }
+  .item img { max-width: 150px; max-height: 150px; }
+</style>
+<input id="search" type="search" placeholder="Search" autofocus size="40"> <span id="count"></span>
+<div id="results"></div>
+<script src="search.js"></script>
+<script>
+  var LIMIT = 200;
+  var haystacks = ITEMS.map(function(item) {
+    return [item.filename, item.category || "", item.tags.join(" "), item.text].join("\\n").toLowerCase();
+  });
+  function escape(text) {
+    var div = document.createElement("div");
+    div.textContent = text;
+    return div.innerHTML;
+  }
+  function show() {
+    var words = document.getElementById("search").value.toLowerCase().split(/\\s+/).filter(Boolean);
+    var matches = [];
+    for (var i = 0; i < ITEMS.length; i++) {
+      if (words.every(function(word) { return haystacks[i].indexOf(word) >= 0; })) {
+        matches.push(ITEMS[i]);
+      }
+    }
+    document.getElementById("count").textContent = matches.length + " scans";
+    document.getElementById("results").innerHTML = matches.slice(0, LIMIT).map(function(item) {
+      var thumbnail = item.thumbnail ? '<img src="thumbnails/' + item.thumbnail + '"><br>' : "";
+      return '<a class="item" href="items/' + item.id + '.html">' + thumbnail + escape(item.filename) +
+        "<br>" + escape(item.category || "") + "</a>";
+    }).join("");
+  }
+  document.getElementById("search").addEventListener("input", show);
+  show();
+</script>
+"""
+
+EXPORTERS = {
+    "sqlite": SqliteExporter,
+    "jsonl": JsonlExporter,
+    "html": HtmlExporter,
+}
+
+
+def export(master, format, output, workers=None):
+    """Export every image under master. Returns (exported, unchanged, removed, errors)"""
+    exporter = EXPORTERS[format](master, output)
+    os.makedirs(exporter.state_path.parent, exist_ok=True)
+    db = sqlite3.connect(exporter.state_path)
+    db.execute("CREATE TABLE IF NOT EXISTS export_state (key TEXT PRIMARY KEY, signature TEXT, record TEXT)")
+    db.execute("CREATE TEMP TABLE seen (key TEXT PRIMARY KEY)")
+    exporter.begin(db)
+    thumbnail_dir = exporter.thumbnail_dir if exporter.thumbnails else None
+    counts = { "unchanged": 0 }
+
+    def changed_images():
+        folder_category = { master: None }
+        for folder, subfolders, files in walk_library(master):
+            for subfolder in subfolders:
+                folder_category[subfolder] = str(subfolder.relative_to(master)) if is_category(subfolder) else folder_category[folder]
+            for path in files:
+                if path.suffix.lower() not in IMAGE_SUFFIXES or output in path.parents: # Not our own thumbnails
+                    continue
+                key = str(path.relative_to(master))
+                signature = _signature(path)
+                db.execute("INSERT OR IGNORE INTO seen VALUES (?)", (key,))
+                row = db.execute("SELECT signature FROM export_state WHERE key = ?", (key,)).fetchone()
+                if row is not None and json.loads(row[0]) == signature:
+                    counts["unchanged"] += 1
+                    continue
+                yield path, key, folder_category[folder], signature, thumbnail_dir
+
+    exported, errors = 0, []
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for key, signature, record in _bounded_map(executor, _read_item, changed_images(), IN_FLIGHT * (workers or os.cpu_count() or 1)):
+                if isinstance(record, str):
+                    errors.append("{}: {}".format(key, record))
+                    continue
+                exporter.put(record)
+                db.execute("INSERT OR REPLACE INTO export_state VALUES (?, ?, ?)", (key, json.dumps(signature), json.dumps(record, default=str)))
+                exported += 1
+                if exported % 1000 == 0: # Keep what we have if interrupted
+                    db.commit()
+
+        removed = 0
+        for key, record in db.execute("SELECT key, record FROM export_state WHERE key NOT IN (SELECT key FROM seen)").fetchall():
+            exporter.remove(json.loads(record))
+            removed += 1
+        db.execute("DELETE FROM export_state WHERE key NOT IN (SELECT key FROM seen)")
+        db.commit()
+        exporter.finish(db, exported + removed > 0)
+    finally:
+        db.commit()
+        db.close()
+    return exported, counts["unchanged"], removed, errors
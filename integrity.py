@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Find (and fix) problems in a scan folder.
+
+Sidecars are parsed in a process pool, and what was read is kept in an index
+keyed by file size and mtime, so a check of an unchanged library only has to
+list folders. That makes it cheap enough to run on every startup, in the
+background, on the folder listing made while loading.
+"""
+import collections
+import concurrent.futures
+import os
+
+import frontmatter
+import yaml
+
+from organize import IMAGE_SUFFIXES, STATE_DIR, file_signature, is_category, load_state, save_state, walk_library
+
+ORPHAN = "orphaned sidecar"
+MISMATCH = "wrong metadata"
+UNPARSEABLE = "unparseable sidecar"
+EMPTY = "empty category"
+DUPLICATE = "duplicate name"
+
+Problem = collections.namedtuple("Problem", ["kind", "path", "detail"])
+
+
+def _read_sidecar(path):
+    """Runs in a worker process"""
+    try:
+        post = frontmatter.load(path)
+    except (yaml.YAMLError, UnicodeDecodeError, TypeError, ValueError) as e:
+        return { "error": str(e).splitlines()[0] }
+    return { "filename": post.get('filename'), "category": post.get('category'), "error": None }
+
+
+class LibraryCheck():
+    def __init__(self, master, workers=None, walk=None):
+        self.master = master
+        self.walk = walk # Results of walk_library(master), if the caller already has them
+        self.workers = workers
+        self.index_path = master.joinpath(STATE_DIR, "check-index.json")
+        self.problems = []
+        # sidecar path -> image path, for images with a sidecar
+        self.images = {}
+        # sidecar path -> expected category name
+        self.categories = {}
+        # image name -> image paths with no sidecar. For reuniting split pairs
+        self.lonely_images = collections.defaultdict(list)
+        # sidecar path -> parsed metadata
+        self.sidecars = {}
+        self._scan()
+
+    def _scan(self):
+        folder_category = { self.master: None }
+        children = collections.defaultdict(list)
+        image_counts = collections.Counter()
+        folders = []
+        sidecar_paths = []
+        for folder, subfolders, files in (self.walk if self.walk is not None else walk_library(self.master)):
+            folders.append(folder)
+            for subfolder in subfolders:
+                children[folder].append(subfolder)
+                if is_category(subfolder):
+                    folder_category[subfolder] = str(subfolder.relative_to(self.master))
+                else:
+                    folder_category[subfolder] = folder_category[folder]
+            by_stem = collections.defaultdict(list)
+            file_set = set(files)
+            for file in files:
+                if file.suffix.lower() in IMAGE_SUFFIXES:
+                    by_stem[file.stem].append(file)
+                elif file.suffix == ".txt":
+                    sidecar_paths.append(file)
+            image_counts[folder] = sum(len(images) for images in by_stem.values())
+            for stem, images in by_stem.items():
+                sidecar = folder.joinpath(stem + ".txt")
+                if len(images) > 1:
+                    self.problems.append(Problem(DUPLICATE, sidecar, "shared by {}".format(", ".join(sorted(x.name for x in images)))))
+                if sidecar in file_set:
+                    self.images[sidecar] = images[0]
+                    self.categories[sidecar] = folder_category[folder]
+                else:
+                    for image in images:
+                        self.lonely_images[image.name].append(image)
+
+        # Folders with nothing in them, or under them
+        for folder in reversed(folders):
+            image_counts[folder] += sum(image_counts[child] for child in children[folder])
+            if image_counts[folder] == 0 and folder != self.master:
+                self.problems.append(Problem(EMPTY, folder, ""))
+
+        self._read_sidecars(sidecar_paths)
+        for sidecar in sidecar_paths:
+            metadata = self.sidecars[sidecar]
+            if metadata["error"] is not None:
+                self.problems.append(Problem(UNPARSEABLE, sidecar, metadata["error"]))
+            elif sidecar not in self.images:
+                self.problems.append(Problem(ORPHAN, sidecar, "for {}".format(metadata["filename"])))
+            else:
+                expected = { "filename": self.images[sidecar].name, "category": self.categories[sidecar] }
+                for field, value in expected.items():
+                    if metadata[field] is not None and metadata[field] != value:
+                        self.problems.append(Problem(MISMATCH, sidecar, "{} is {!r}, should be {!r}".format(field, metadata[field], value)))
+
+    def _read_sidecars(self, sidecar_paths):
+        index = load_state(self.index_path)
+        new_index = {}
+        unread = []
+        for sidecar in sidecar_paths:
+            key = str(sidecar.relative_to(self.master))
+            signature = file_signature(sidecar)
+            if key in index and index[key]["signature"] == signature:
+                self.sidecars[sidecar] = index[key]["metadata"]
+                new_index[key] = index[key]
+            else:
+                unread.append((sidecar, key, signature))
+        if len(unread) > 0:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(_read_sidecar, [sidecar for sidecar, _, _ in unread], chunksize=64)
+                for (sidecar, key, signature), metadata in zip(unread, results):
+                    self.sidecars[sidecar] = metadata
+                    new_index[key] = { "signature": signature, "metadata": metadata }
+        if new_index != index:
+            save_state(self.index_path, new_index)
+
+    def repair(self):
+        """Fix everything fixable in one pass. Returns a description of each fix"""
+        fixes = []
+        by_kind = collections.defaultdict(list)
+        for problem in self.problems:
+            by_kind[problem.kind].append(problem)
+
+        fixed_sidecars = set()
+        for problem in by_kind[MISMATCH]:
+            sidecar = problem.path
+            if sidecar in fixed_sidecars:
+                continue
+            post = frontmatter.load(sidecar)
+            post['filename'] = self.images[sidecar].name
+            if self.categories[sidecar] is not None:
+                post['category'] = self.categories[sidecar]
+            else:
+                post.metadata.pop('category', None)
+            frontmatter.dump(post, sidecar)
+            fixed_sidecars.add(sidecar)
+            fixes.append("Fixed metadata in {}".format(sidecar))
+
+        orphanage = self.master.joinpath(STATE_DIR, "orphans")
+        for problem in by_kind[ORPHAN]:
+            sidecar = problem.path
+            candidates = self.lonely_images.get(self.sidecars[sidecar]["filename"], [])
+            if len(candidates) == 1:
+                # An interrupted move: the image went on ahead without its sidecar
+                image = candidates.pop()
+                new_sidecar = image.with_suffix(".txt")
+                os.rename(sidecar, new_sidecar)
+                post = frontmatter.load(new_sidecar)
+                category = image.parent
+                while category != self.master and not is_category(category):
+                    category = category.parent
+                if category != self.master:
+                    post['category'] = str(category.relative_to(self.master))
+                frontmatter.dump(post, new_sidecar)
+                fixes.append("Moved {} next to {}".format(sidecar, image))
+            else:
+                # Keep it out of the way rather than deleting someone's transcription
+                new_path = orphanage.joinpath(sidecar.relative_to(self.master))
+                os.makedirs(new_path.parent, exist_ok=True)
+                os.rename(sidecar, new_path)
+                fixes.append("Moved orphan {} to {}".format(sidecar, new_path))
+
+        # Deepest first, so parents are empty by the time we reach them
+        for problem in sorted(by_kind[EMPTY], key=lambda p: len(p.path.parts), reverse=True):
+            try:
+                problem.path.rmdir()
+                fixes.append("Removed empty folder {}".format(problem.path))
+            except OSError: # Has non-image files in it
+                pass
+        return fixes
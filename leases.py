@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import socket
+import time
+import uuid
+
+
+UNREADABLE_GRACE = 5 # seconds. An unreadable lease older than this was left by a crash
+
+
+class Leases():
+    """Cooperative per-image locks, so several instances can share one scan folder.
+
+    Each lease is a small file in lease_dir naming its owner and when it expires.
+    Leases are only advisory: an instance that crashes stops renewing its leases,
+    and other instances take them over once they expire.
+
+    Lease files are written in full before they appear (via a hard link, which
+    fails if the lease exists), and an expired lease is claimed by renaming it
+    away, which only one instance can do.
+    """
+    def __init__(self, lease_dir, duration=300):
+        self.lease_dir = lease_dir
+        self.duration = duration # seconds
+        self.owner = "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.held = {} # key -> lease path
+
+    def acquire(self, key):
+        """Take (or renew) the lease for key. Returns False if another instance holds it"""
+        path = self._lease_path(key)
+        lease = self._read(path)
+        now = time.time()
+        if lease is not None and lease["owner"] != self.owner and lease["expires"] > now:
+            return False
+        os.makedirs(self.lease_dir, exist_ok=True)
+        if lease is not None and lease["owner"] == self.owner and lease["expires"] > now:
+            # Renewing. Nobody else takes a lease before it expires
+            self._write(path, key)
+        else:
+            if lease is not None and not self._claim_expired(path):
+                return False
+            if not self._publish(path, key):
+                return False # Someone beat us to it
+        self.held[key] = path
+        return True
+
+    def is_held_by_other(self, key):
+        lease = self._read(self._lease_path(key))
+        return lease is not None and lease["owner"] != self.owner and lease["expires"] > time.time()
+
+    def release(self, key):
+        path = self.held.pop(key, None)
+        if path is not None:
+            lease = self._read(path)
+            if lease is not None and lease["owner"] == self.owner:
+                path.unlink(missing_ok=True)
+
+    def release_all(self):
+        for key in list(self.held):
+            self.release(key)
+
+    def renew(self):
+        """Renew every lease we hold. Returns the keys of any we lost"""
+        lost = []
+        for key in list(self.held):
+            if not self.acquire(key):
+                del self.held[key]
+                lost.append(key)
+        return lost
+
+    def _lease_path(self, key):
+        return self.lease_dir.joinpath(hashlib.sha1(key.encode("utf8")).hexdigest() + ".lease")
+
+    def _tmp_path(self, path, kind):
+        return path.with_name("{}.{}.{}".format(path.name, self.owner, kind))
+
+    def _read(self, path):
+        """The lease in path, or None if there is none"""
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError: # Empty or cut short. Expires a little after it was last written
+            try:
+                modified = path.stat().st_mtime
+            except FileNotFoundError:
+                return None
+            return { "key": None, "owner": None, "expires": modified + UNREADABLE_GRACE }
+
+    def _claim_expired(self, path):
+        """Move an expired lease out of the way. Returns False if someone else got there first"""
+        claimed_path = self._tmp_path(path, "expired")
+        try:
+            os.rename(path, claimed_path)
+        except FileNotFoundError: # Someone else moved it. Whoever publishes first gets it
+            return True
+        lease = self._read(claimed_path)
+        if lease is not None and lease["owner"] != self.owner and lease["expires"] > time.time():
+            # We moved a fresh lease, which replaced the expired one after we looked. Put it
+            # back. If someone has published another meanwhile, the owner finds out on renewal
+            try:
+                os.link(claimed_path, path)
+            except FileExistsError:
+                pass
+            claimed_path.unlink()
+            return False
+        claimed_path.unlink(missing_ok=True)
+        return True
+
+    def _publish(self, path, key):
+        """Create the lease for key, unless one exists"""
+        tmp_path = self._tmp_path(path, "tmp")
+        self._dump(tmp_path, key)
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            tmp_path.unlink()
+
+    def _write(self, path, key):
+        tmp_path = self._tmp_path(path, "tmp")
+        self._dump(tmp_path, key)
+        os.replace(tmp_path, path)
+
+    def _dump(self, path, key):
+        with open(path, "w") as f:
+            json.dump({ "key": key, "owner": self.owner, "expires": time.time() + self.duration }, f)
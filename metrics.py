@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Timing for the slow parts of the app, and for the human using it.
+
+Latencies go into histograms. Time spent in each phase is split into time the
+app kept you waiting (any timed() section on the main thread) and the rest,
+which is "human" time. Everything is appended to a local JSON-lines file, one
+line per save, and summarized by report().
+"""
+import collections
+import contextlib
+import datetime
+import json
+import math
+import os
+import threading
+import time
+
+IDLE_SECONDS = 300 # Longer gaps between images count as a break, not work
+
+
+class Histogram():
+    """Latency histogram with power-of-two millisecond buckets"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0 # seconds
+        self.max = 0.0
+        self.buckets = collections.Counter() # upper bound in ms -> count
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[2**max(0, math.ceil(math.log2(max(seconds*1000, 1))))] += 1
+
+    def merge(self, data):
+        self.count += data["count"]
+        self.total += data["total"]
+        self.max = max(self.max, data["max"])
+        self.buckets.update({ int(k): v for k, v in data["buckets"].items() })
+
+    def percentile(self, p):
+        """Upper bound (in ms) of the bucket holding the p-th percentile"""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= p * self.count:
+                return bucket
+        return 0
+
+    def to_json(self):
+        return { "count": self.count, "total": self.total, "max": self.max, "buckets": dict(self.buckets) }
+
+
+class PhaseTimes():
+    def __init__(self):
+        self.completed = 0
+        self.human = 0.0 # seconds
+        self.app = 0.0 # seconds
+        self.backlog = None
+
+    def merge(self, data):
+        self.completed += data["completed"]
+        self.human += data["human"]
+        self.app += data["app"]
+        if data["backlog"] is not None:
+            self.backlog = data["backlog"]
+
+    def to_json(self):
+        return { "completed": self.completed, "human": self.human, "app": self.app, "backlog": self.backlog }
+
+
+class Metrics():
+    def __init__(self):
+        self.path = None
+        self._lock = threading.Lock()
+        self._reset()
+        self._phase = None
+        self._mark = time.monotonic()
+        self._app_since_mark = 0.0
+        self._depth = 0 # Nesting of timed() sections on the main thread
+
+    def _reset(self):
+        self.histograms = collections.defaultdict(Histogram)
+        self.phases = collections.defaultdict(PhaseTimes)
+        self.since = time.time()
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Time a section of code. Also usable as a decorator"""
+        main = threading.current_thread() is threading.main_thread()
+        if main:
+            self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.histograms[name].add(elapsed)
+            if main:
+                self._depth -= 1
+                if self._depth == 0: # Don't count nested sections twice
+                    self._app_since_mark += elapsed
+                    if self._phase is not None:
+                        self.phases[self._phase].app += elapsed
+
+    def set_phase(self, phase):
+        """The user switched to working on phase"""
+        self._phase = phase
+        self._mark, self._app_since_mark = time.monotonic(), 0.0
+
+    def completed(self, phase):
+        """The user finished an image in phase"""
+        now = time.monotonic()
+        human = min(max(now - self._mark - self._app_since_mark, 0), IDLE_SECONDS)
+        self.phases[phase].completed += 1
+        self.phases[phase].human += human
+        self._mark, self._app_since_mark = now, 0.0
+
+    def set_backlog(self, phase, todo):
+        self.phases[phase].backlog = todo
+
+    def save(self):
+        """Append everything measured since the last save to the metrics file"""
+        if self.path is None:
+            return
+        with self._lock:
+            record = {
+                "since": self.since,
+                "until": time.time(),
+                "histograms": { name: h.to_json() for name, h in self.histograms.items() },
+                "phases": { phase: times.to_json() for phase, times in self.phases.items() },
+            }
+            self._reset()
+        os.makedirs(self.path.parent, exist_ok=True)
+        line = json.dumps(record) + "\n"
+        if not self._ends_cleanly():
+            line = "\n" + line # Don't glue this record onto the end of a damaged one
+        with open(self.path, "a") as f:
+            f.write(line)
+
+    def _ends_cleanly(self):
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                return f.read(1) == b"\n"
+        except (FileNotFoundError, OSError): # Missing or empty
+            return True
+
+
+def load(path):
+    """Merge every record in a metrics file"""
+    histograms = collections.defaultdict(Histogram)
+    phases = collections.defaultdict(PhaseTimes)
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError: # Cut short by a crash, or mixed with another instance's save
+                continue
+            for name, data in record["histograms"].items():
+                histograms[name].merge(data)
+            for phase, data in record["phases"].items():
+                phases[phase].merge(data)
+    return histograms, phases
+
+
+def _duration(seconds):
+    if seconds is None:
+        return "-"
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def report(path):
+    """Human throughput, app wait time and ETA per phase, then latencies"""
+    histograms, phases = load(path)
+    lines = ["{:<26} {:>6} {:>10} {:>10} {:>10} {:>8} {:>10}".format("Phase", "Done", "Images/h", "Human", "App wait", "Backlog", "ETA")]
+    for phase, times in phases.items():
+        rate = times.completed / times.human * 3600 if times.human > 0 else None
+        eta = times.backlog / rate * 3600 if rate and times.backlog is not None else None
+        lines.append("{:<26} {:>6} {:>10} {:>10} {:>10} {:>8} {:>10}".format(
+            phase, times.completed, "-" if rate is None else "{:.1f}".format(rate),
+            _duration(times.human), _duration(times.app),
+            "-" if times.backlog is None else times.backlog, _duration(eta),
+        ))
+    lines.append("")
+    lines.append("{:<26} {:>6} {:>10} {:>10} {:>10} {:>10}".format("Latency (ms)", "Count", "Mean", "p50", "p95", "Max"))
+    for name, h in sorted(histograms.items()):
+        lines.append("{:<26} {:>6} {:>10.1f} {:>10} {:>10} {:>10.1f}".format(
+            name, h.count, h.total / h.count * 1000, h.percentile(0.5), h.percentile(0.95), h.max * 1000,
+        ))
+    return "\n".join(lines)
+
+
+METRICS = Metrics()
+timed = METRICS.timed
+set_phase = METRICS.set_phase
+completed = METRICS.completed
+set_backlog = METRICS.set_backlog
+save = METRICS.save
@@ -1,14 +1,92 @@
 #!/usr/bin/env python3
 import collections
 import functools
+import json
 import os
+import pathlib
+import re
+import threading
+import time
 
 import frontmatter
 
+import leases
+import metrics
 import ui
 from ui import Extras
 
 
+STATE_DIR = ".scan-organizer" # Per-library state, inside the master folder
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".webp"} | ui.MULTIPAGE_SUFFIXES
+PAGE_MARKER = re.compile(r"^\[page (\d+)\]$", re.MULTILINE) # Separates pages in a transcription
+
+
+def walk_library(master, recursive=True):
+    """Yields (folder, subfolders, files) for each folder in the library, like os.walk"""
+    folders = [master]
+    for folder in folders:
+        subfolders, files = [], []
+        for x in folder.iterdir():
+            if x.is_file():
+                files.append(x)
+            elif x.is_dir() and recursive and not x.name.startswith("."): # Skip STATE_DIR
+                subfolders.append(x)
+        yield folder, subfolders, files
+        folders.extend(subfolders)
+
+
+def load_state(path):
+    """Read a JSON file from STATE_DIR. Missing or damaged files (eg cut short by a crash) read as empty"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_state(path, data):
+    """Write a JSON file to STATE_DIR. Other instances see the old file or the new one, never part of one"""
+    os.makedirs(path.parent, exist_ok=True)
+    tmp_path = path.with_name("{}.{}.tmp".format(path.name, os.getpid()))
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def file_signature(path):
+    """Size and mtime of a file, to tell whether it changed since a result was saved"""
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def walk_images(master, done, leftover_suffix=None):
+    """Yields the path of each single-page image under master which still needs work.
+
+    done maps keys to the file_signature an image had when it was finished. Images
+    another instance has open are skipped, and files ending in leftover_suffix (left
+    by an interrupted run) are deleted.
+    """
+    image_leases = leases.Leases(master.joinpath(STATE_DIR, "leases"))
+    for _, _, files in walk_library(master):
+        for path in files:
+            key = str(path.relative_to(master))
+            if leftover_suffix is not None and path.name.endswith(leftover_suffix):
+                path.unlink()
+                continue
+            if path.suffix.lower() not in IMAGE_SUFFIXES or path.suffix.lower() in ui.MULTIPAGE_SUFFIXES:
+                continue
+            if done.get(key) == file_signature(path):
+                continue
+            if image_leases.is_held_by_other(key): # Someone has it open
+                continue
+            yield path
+
+
+def is_category(folder):
+    """Whether a folder in the library is a category"""
+    return "unsorted" not in str(folder)
+
+
 class SaveInvalidError(ui.ButtonActionInvalidError):
     pass
 
@@ -31,43 +109,123 @@ class RecencyQueue():
         return iter(self.list)
 
 
+class CategoryList(list):
+    """A list of categories which counts changes, so the UI knows when to redraw it"""
+    def __init__(self):
+        super().__init__()
+        self.version = 0
+    def append(self, category):
+        super().append(category)
+        self.changed()
+    def changed(self):
+        self.version += 1
+
+
 class OrganizerCategory():
-    def __init__(self, path, name):
-        self.path = path
-        self.name = name
+    """A category folder.
+
+    Subcategories store only their path relative to their parent, so renaming a
+    category implicitly moves every subcategory (and every image) beneath it.
+    """
+    def __init__(self, path, name, parent=None):
+        self.parent = None
+        self._path = path
+        self._name = name
+        self.set_parent(parent)
+
+    @property
+    def path(self):
+        if self.parent is None:
+            return self._path
+        return self.parent.path.joinpath(self._path)
+
+    @property
+    def name(self):
+        if self.parent is None:
+            return self._name
+        return str(pathlib.PurePath(self.parent.name, self._name))
+
+    def set_parent(self, parent):
+        path, name = self.path, self.name
+        self.parent = parent
+        if parent is None:
+            self._path, self._name = path, name
+        else:
+            self._path = path.relative_to(parent.path)
+            self._name = str(pathlib.PurePath(name).relative_to(parent.name))
+
+    def is_within(self, other):
+        """True if this is other, or a subcategory of it"""
+        category = self
+        while category is not None:
+            if category is other:
+                return True
+            category = category.parent
+        return False
+
     def rename(self, new_path, new_name):
         if new_path.exists():
             raise ImageClobberingError()
         old_path = self.path
         os.rename(old_path, new_path)
-        self.path = new_path
-        self.name = new_name
+        self.parent = None
+        self._path = new_path
+        self._name = new_name
         return self
 
 
 class OrganizerImage():
     def __init__(self, path, category, index):
-        self.image_path = path
-        self.transcription_path = self._transcription_path(self.image_path)
         self.index = index # an id
         self.category = category
-        if self.transcription_path.exists():
+        self.image_path = path
+        self._page_count = None
+        self._lock = threading.RLock() # Sidecars may be rewritten in the background
+        self._load()
+
+    def _load(self):
+        self._loaded_mtime = self._transcription_mtime()
+        if self._loaded_mtime is not None:
             self.textfm = frontmatter.load(self.transcription_path)
         else:
             self.textfm = frontmatter.Post("")
             self.textfm['tags'] = []
 
+    def reload(self):
+        """Re-read the sidecar, if something else (such as another instance) changed it"""
+        with self._lock:
+            if self._transcription_mtime() != self._loaded_mtime:
+                self._load()
+
+    def _transcription_mtime(self):
+        try:
+            return self.transcription_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
     def rename(self, new_name):
         self._move(self.image_path.parent.joinpath(new_name + self.image_path.suffix.lower()))
 
-    def set_category(self, category, move=True):
-        self.category = category
-        new_path = category.path.joinpath(self.image_path.name)
-        if move:
-            self._move(new_path)
+    @property
+    def image_path(self):
+        # Stored relative to the category, so renaming a category is free
+        if self.category is None:
+            return self._image_path
+        return self.category.path.joinpath(self._image_path)
+
+    @image_path.setter
+    def image_path(self, path):
+        if self.category is None:
+            self._image_path = path
         else:
-            self.image_path = new_path
-            self.transcription_path = self._transcription_path(new_path)
+            self._image_path = path.relative_to(self.category.path)
+
+    @property
+    def transcription_path(self):
+        return self._transcription_path(self.image_path)
+
+    def set_category(self, category):
+        self._move(category.path.joinpath(self.image_path.name), category=category)
 
     @property
     def metadata_string(self):
@@ -82,6 +240,39 @@ class OrganizerImage():
         self.textfm.content = content
         self._save_text()
 
+    @property
+    def page_count(self):
+        if self._page_count is None:
+            if self.image_path.suffix.lower() in ui.MULTIPAGE_SUFFIXES:
+                try:
+                    self._page_count = ui.page_count(self.image_path)
+                except (OSError, ValueError): # Damaged. Treat it as one page, keeping the whole transcription
+                    self._page_count = 1
+            else:
+                self._page_count = 1
+        return self._page_count
+
+    @property
+    def page_transcriptions(self):
+        """The transcription of each page. Multi-page transcriptions are stored as [page N] sections"""
+        if self.page_count == 1:
+            return [self.transcription]
+        pages = [""] * self.page_count
+        parts = PAGE_MARKER.split(self.transcription)
+        if parts[0].strip() != "": # Transcribed before it was split into pages
+            pages[0] = parts[0].strip("\n")
+        for number, text in zip(parts[1::2], parts[2::2]):
+            if 0 < int(number) <= self.page_count:
+                pages[int(number) - 1] = text.strip("\n")
+        return pages
+
+    @page_transcriptions.setter
+    def page_transcriptions(self, pages):
+        if len(pages) == 1:
+            self.transcription = pages[0]
+        else:
+            self.transcription = "\n\n".join("[page {}]\n{}".format(i + 1, text.strip("\n")) for i, text in enumerate(pages))
+
     def delete(self):
         self.tag("+deleted")
         self.image_path.unlink()
@@ -116,34 +307,48 @@ class OrganizerImage():
                 return False
         return True
 
-    def _save_text(self):
-        self.textfm['filename'] = self.image_path.name
-        if self.category is not None:
-            self.textfm['category'] = self.category.name
-        frontmatter.dump(self.textfm, self.transcription_path)
+    def save_category(self):
+        """Rewrite the sidecar's category, if there is a sidecar"""
+        with self._lock:
+            if self.transcription_path.exists():
+                self._save_text()
 
-    def _move(self, new_path):
+    @metrics.timed("save_text")
+    def _save_text(self):
+        with self._lock:
+            self.textfm['filename'] = self.image_path.name
+            if self.category is not None:
+                self.textfm['category'] = self.category.name
+            frontmatter.dump(self.textfm, self.transcription_path)
+            self._loaded_mtime = self._transcription_mtime()
+
+    @metrics.timed("move")
+    def _move(self, new_path, category=None):
         if new_path == self.image_path:
             return
         if new_path.exists():
             raise ImageClobberingError()
-        old_image_path, self.image_path = self.image_path, new_path
-        old_transcription_path, self.transcription_path = self.transcription_path, self._transcription_path(self.image_path)
+        with self._lock:
+            old_image_path, old_transcription_path = self.image_path, self.transcription_path
+            if category is not None:
+                self.category = category
+            self.image_path = new_path
 
-        os.rename(old_image_path, self.image_path)
-        if old_transcription_path.exists():
-            os.rename(old_transcription_path, self.transcription_path)
+            os.rename(old_image_path, self.image_path)
+            if old_transcription_path.exists():
+                os.rename(old_transcription_path, self.transcription_path)
+            self._loaded_mtime = self._transcription_mtime()
 
     def _transcription_path(self, image_path):
         return image_path.parent.joinpath(image_path.stem + ".txt")
 
 
 class Organizer():
-    def __init__(self, new_category_root):
-        self.window = ui.TranscriptionWindow()
+    def __init__(self, new_category_root, window=None):
+        self.window = window if window is not None else ui.TranscriptionWindow()
         self.new_category_root = new_category_root
         self.images = []
-        self.categories = []
+        self.categories = CategoryList()
         self._phases = []
         self.recent_categories = RecencyQueue(10)
         # phase -> All images for that phase, at least those unfinished at the program start. As indices
@@ -154,6 +359,21 @@ class Organizer():
         self._phase_tags = {}
         # phase -> current selected image
         self._phase_index = collections.defaultdict(lambda: None)
+        # category -> Images directly in that category. As indices
+        self._category_images = collections.defaultdict(set)
+        # category path -> category. Rebuilt lazily after a rename
+        self._category_paths = None
+        # Deleted, or moved away by another instance. As indices
+        self._removed = set()
+        # While loading, progress is only shown every so often
+        self._loading = False
+        self._rescanning = False
+        self._background_threads = []
+        # Other instances may be working in the same folder. Lease images before showing them
+        self.leases = leases.Leases(new_category_root.joinpath(STATE_DIR, "leases"))
+        # image index -> lease key, for images shown in some phase
+        self._leased = {}
+        metrics.METRICS.path = new_category_root.joinpath(STATE_DIR, "metrics.jsonl")
 
     def add_phase(self, tags, **kwargs):
         phase = self.window.add_phase(get_categories=self.get_categories, **kwargs)
@@ -176,23 +396,120 @@ class Organizer():
     def add_image(self, image_path):
         image = OrganizerImage(image_path, self._find_category(image_path), index=len(self.images))
         self.images.append(image)
+        self._category_images[image.category].add(image.index)
 
         for phase, tags, phase_index, images, work_images in self.phases():
             if image.match_tags(tags):
                 images.append(image.index)
                 work_images.append(image.index)
-                phase.increment_todo(1)
-                if phase_index is None:
-                    self.set_image(phase, image.index)
-            else:
-                phase.increment_skipped(1)
+        self._progress_changed()
 
     def add_category(self, category_path, category_name):
-        category = OrganizerCategory(category_path, category_name)
+        category = OrganizerCategory(category_path, category_name, parent=self._find_category(category_path))
         self.categories.append(category)
+        if self._category_paths is not None:
+            self._category_paths[category.path] = category
 
     def display(self):
+        self._renew_leases()
+        self.window.after(60000, self._save_metrics)
         self.window.mainloop()
+        self.leases.release_all()
+        self._save_metrics(repeat=False)
+        for thread in self._background_threads:
+            thread.join()
+
+    def _save_metrics(self, repeat=True):
+        for phase, _, _, _, work_images in self.phases():
+            metrics.set_backlog(phase.id, len(work_images))
+        metrics.save()
+        if repeat:
+            self.window.after(60000, self._save_metrics)
+
+    def _renew_leases(self):
+        lost = self.leases.renew()
+        for index, key in list(self._leased.items()):
+            if key in lost: # Expired, and another instance took it over
+                del self._leased[index]
+                for phase, _, phase_index, _, _ in self.phases():
+                    if phase_index == index:
+                        self.next_work(phase, self.images[index])
+        self.rescan()
+        self.window.after(int(self.leases.duration * 1000 / 3), self._renew_leases)
+
+    def load(self, steps, background=False):
+        """Run a loading generator, which yields a status message every so often.
+
+        In the background, it runs from the Tk loop in short slices, so the window
+        appears right away and shows how loading is going.
+        """
+        self._loading = True
+        if not background:
+            for _ in steps:
+                pass
+            self._finish_loading()
+            return
+        self._in_slices(steps, self._finish_loading, show_status=True)
+
+    def _in_slices(self, steps, finish, show_status=False):
+        """Run a generator from the Tk loop, a few milliseconds at a time, then call finish()"""
+        last_shown = 0
+        def step():
+            nonlocal last_shown
+            deadline = time.monotonic() + 0.05
+            for status in steps:
+                if time.monotonic() > deadline:
+                    break
+            else:
+                finish()
+                return
+            if show_status and time.monotonic() - last_shown > 0.25:
+                last_shown = time.monotonic()
+                for phase in self._phases:
+                    phase.set_loading(status)
+            self.window.after(1, step)
+        self.window.after(0, step)
+
+    def rescan(self):
+        """Pick up images and categories which other instances added, moved or renamed, in the background"""
+        if self._loading or self._rescanning:
+            return
+        steps = self._rescan_steps()
+        if steps is not None:
+            self._rescanning = True
+            self._in_slices(steps, self._finish_rescan)
+
+    def _rescan_steps(self):
+        """A generator doing the rescan, for subclasses which know where images come from"""
+        return None
+
+    def _finish_rescan(self):
+        self._rescanning = False
+        for phase, _, phase_index, _, work_images in self.phases():
+            if phase_index is None and len(work_images) > 0: # New work for a finished phase
+                self.set_image(phase, self._first_claimable(work_images))
+        self._progress_changed()
+
+    def _first_claimable(self, work_images):
+        for index in list(work_images):
+            if self._claim(self.images[index]):
+                if index in work_images:
+                    return index
+                self._release(self.images[index]) # Someone else finished it
+
+    def _finish_loading(self):
+        self._loading = False
+        for phase, _, _, _, work_images in self.phases():
+            self.set_image(phase, self._first_claimable(work_images))
+        self._progress_changed()
+        self.autoselect_phase()
+
+    def _progress_changed(self):
+        if self._loading:
+            return
+        live_images = len(self.images) - len(self._removed)
+        for phase, _, _, images, work_images in self.phases():
+            phase.set_progress(todo=len(work_images), finished=len(images) - len(work_images), skipped=live_images - len(images))
 
     def autoselect_phase(self):
         best_phase = None
@@ -206,6 +523,10 @@ class Organizer():
         """Use if the selected image changed for a phase"""
         old_index = self._phase_index[phase]
         self.set_phase_index(phase, new_index)
+        if new_index is not None:
+            self._lease(self.images[new_index])
+        if old_index is not None and old_index != new_index:
+            self._release(self.images[old_index])
         tags, phase_index, images, work_images = self.phase_info(phase)
         if len(images) == 0 or new_index is None:
             assert new_index is None
@@ -234,11 +555,13 @@ class Organizer():
                     recent_categories=self.recent_categories,
                 )
 
+    @metrics.timed("switch_index")
     def _switch_index(self, phase, offset, working_set):
         _, current_index, _, _ = self.phase_info(phase)
         if len(working_set) == 0:
             new_index = None
         else:
+            direction = 1 if offset >= 0 else -1
             if current_index not in working_set:
                 if offset > 0:
                     offset -= 1
@@ -255,39 +578,99 @@ class Organizer():
                     except ValueError:
                         current_index = max(working_set)
             work_index = working_set.index(current_index)
-            next_work_index = (work_index + offset) % len(working_set)
-            new_index = working_set[next_work_index]
+            # Skip images which another instance is working on, or which it changed or moved
+            candidates = [working_set[(work_index + offset + direction*i) % len(working_set)] for i in range(len(working_set))]
+            new_index = None
+            for candidate in candidates:
+                if self._claim(self.images[candidate]):
+                    if candidate in working_set:
+                        new_index = candidate
+                        break
+                    self._release(self.images[candidate]) # Someone else finished it
 
         self.set_image(phase, new_index)
 
-    def _find_category(self, image_path):
-        """Figure out the (narrowest) category an image is in"""
-        correct_category = None
-        for category in self.categories:
-            if str(image_path).startswith(str(category.path)):
-                if correct_category is None or len(str(category.path)) > len(str(correct_category.path)):
-                    correct_category = category
-        return correct_category
+    def _lease_key(self, image):
+        return str(image.image_path.relative_to(self.new_category_root))
+
+    def _lease(self, image):
+        """Returns False if another instance holds the image"""
+        if image.index not in self._leased:
+            key = self._lease_key(image)
+            if not self.leases.acquire(key):
+                return False
+            self._leased[image.index] = key
+        return True
+
+    def _release(self, image):
+        if image.index in self._leased and image.index not in self._phase_index.values():
+            self.leases.release(self._leased.pop(image.index))
+
+    def _claim(self, image):
+        """Check an image is free to work on, picking up any changes other instances made to it"""
+        if image.index in self._leased:
+            return True # We are already showing it
+        if not image.image_path.exists(): # Moved, deleted or renamed by another instance
+            self._forget(image)
+            self.rescan() # Find it again, wherever it went
+            return False
+        if not self._lease(image):
+            return False
+        self._retag(image, image.reload)
+        return True
+
+    def _find_category(self, path):
+        """Figure out the (narrowest) category an image or folder is in"""
+        if self._category_paths is None:
+            self._category_paths = { category.path: category for category in self.categories }
+        for parent in path.parents:
+            if parent in self._category_paths:
+                return self._category_paths[parent]
+
+    def _set_image_category(self, image, category):
+        old_category = image.category
+        image.set_category(category)
+        self._category_images[old_category].discard(image.index)
+        self._category_images[category].add(image.index)
+
+    def _known_category(self, category_path):
+        self._find_category(category_path) # Builds the index
+        return category_path in self._category_paths
 
     def on_create_category(self, category_name):
         category_path = self.new_category_root.joinpath(category_name)
-        category = OrganizerCategory(category_path, category_name)
         try:
             os.makedirs(category_path)
         except FileExistsError:
-            raise ui.ButtonActionInvalidError("That category already exists")
-        self.categories.append(category)
+            if self._known_category(category_path):
+                raise ui.ButtonActionInvalidError("That category already exists")
+            # Another instance made it. Now we have it too
+        self.add_category(category_path, category_name)
 
     def on_rename_category(self, old_category, new_name):
-        new_category = old_category.rename(self.new_category_root.joinpath(new_name), new_name)
-        for image in self.images:
-            if image.category == old_category:
-                image.set_category(new_category, move=False)
+        new_path = self.new_category_root.joinpath(new_name)
+        if old_category.path in new_path.parents:
+            raise ui.ButtonActionInvalidError("A category cannot be moved inside itself")
+        # Images and subcategories hang off the category, so they follow it without being touched
+        category = old_category.rename(new_path, new_name)
+        self._category_paths = None
+        category.set_parent(self._find_category(category.path))
+        self.categories.changed()
+        thread = threading.Thread(target=self._save_category_images, args=(category,), daemon=True)
+        thread.start()
+        self._background_threads.append(thread)
+
+    def _save_category_images(self, renamed_category):
+        """Rewrite the 'category' field of sidecars after a rename. Slow, so runs in the background"""
+        for category in list(self.categories):
+            if category.is_within(renamed_category):
+                for index in list(self._category_images[category]):
+                    self.images[index].save_category()
 
     def get_categories(self, category_name):
         for cat in self.categories:
             if cat.name == category_name:
-                return self.categories, self.recent_categories
+                return cat, self.categories, self.recent_categories
 
     # Common (model-level) buttons
     def next(self, phase, image):
@@ -307,24 +690,28 @@ class Organizer():
         return self._switch_index(phase, -1, work_images)
 
     def delete(self, phase, image, metadata_only=False):
+        metrics.completed(phase.id)
+        self._forget(image)
+        if metadata_only:
+            image.delete_metadata()
+        else:
+            image.delete()
+
+    def _forget(self, image):
+        """Remove an image from every phase"""
         for phase, tags, phase_index, images, work_images in self.phases():
             if phase_index == image.index:
                 self.next_work(phase, image)
 
-            if image.index in work_images:
-                phase.increment_todo(-1)
-            else:
-                phase.increment_finished(-1)
-
             if image.index in work_images:
                 work_images.remove(image.index)
             if image.index in images:
                 images.remove(image.index)
 
-        if metadata_only:
-            image.delete_metadata()
-        else:
-            image.delete()
+        self._removed.add(image.index)
+        self._category_images[image.category].discard(image.index)
+        self._release(image)
+        self._progress_changed()
 
     def delete_metadata(self, phase, image):
         self.delete(phase, image, metadata_only=True)
@@ -333,8 +720,16 @@ class Organizer():
         return lambda phase, image: self._tag(tag, phase, image) 
 
     def _tag(self, tag, phase, image):
+        _, _, _, work_images = self.phase_info(phase)
+        was_work = image.index in work_images
+        self._retag(image, functools.partial(image.tag, tag))
+        if was_work and image.index not in work_images:
+            metrics.completed(phase.id)
+
+    def _retag(self, image, change):
+        """Update which phases an image is in, after change() alters its tags"""
         before = { phase: image.match_tags(tags) for phase, tags, _, _, _ in self.phases() }
-        image.tag(tag)
+        change()
         after  = { phase: image.match_tags(tags) for phase, tags, _, _, _ in self.phases() }
         for phase, tags, phase_index, images, work_images in self.phases():
             if before[phase] == False and after[phase] == True:
@@ -342,18 +737,12 @@ class Organizer():
                 assert image.index not in work_images
                 if image.index not in work_images:
                     work_images.append(image.index)
-                    phase.increment_todo(1)
                     if image.index not in images:
                         images.append(image.index)
-                        phase.increment_skipped(-1)
-                    else:
-                        phase.increment_finished(-1)
                 if len(work_images) == 1: # New first image
                     self.set_image(phase, image.index)
             elif before[phase] == True and after[phase] == False:
                 # Removed from phase.
-                phase.increment_todo(-1)
-                phase.increment_finished(1)
                 if phase_index == image.index: # advance the cursor, too
                     self.next_work(phase, image)
                 work_images.remove(image.index)
@@ -361,6 +750,7 @@ class Organizer():
                     self.set_image(phase, None)
                     phase.set_done(True, popup=True)
                     self.autoselect_phase()
+        self._progress_changed()
 
 
     # Default extras (UI-level) buttons
@@ -368,7 +758,7 @@ class Organizer():
         category = phase.get_extra(Extras.CATEGORY_PICKER).get_category()
         if category is None:
             raise SaveInvalidError("Category not selected")
-        image.set_category(category)
+        self._set_image_category(image, category)
         self.recent_categories.add(category)
 
     def save_name(self, phase, image):
@@ -378,7 +768,7 @@ class Organizer():
         image.rename(name)
 
     def save_transcription(self, phase, image):
-        transcription = phase.get_extra(Extras.TRANSCRIBE).get_transcription()
-        if transcription is None or transcription.strip() == "":
+        pages = phase.get_extra(Extras.TRANSCRIBE).get_transcription()
+        if pages is None or all(page.strip() == "" for page in pages):
             raise SaveInvalidError("Transcription is empty")
-        image.transcription = transcription
+        image.page_transcriptions = pages
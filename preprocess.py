@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Find sideways and slightly skewed scans before Phase 1.
+
+Each uncleaned image is analysed in a process pool. Sideways images are found
+by comparing how "stripey" the rows and columns are (lines of text make rows
+stripey), and skew by finding the small rotation that makes the rows most
+stripey. Suggestions are written to the sidecar, for Phase 1 to apply with one
+key. With apply=True, 90 degree rotations of JPEGs (with jpegtran), PNGs and
+still GIFs are done losslessly right away, and checked pixel for pixel. Other
+images keep the suggestion.
+Results are cached by file size and mtime, so re-runs only look at new files.
+"""
+import concurrent.futures
+import os
+import subprocess
+
+import PIL.Image
+import PIL.ImageOps
+import PIL.PngImagePlugin
+import yaml
+
+import recompress
+from organize import OrganizerImage, STATE_DIR, file_signature, load_state, save_state, walk_images
+
+ANALYSIS_SIZE = 600 # pixels. Plenty to see lines of text
+SIDEWAYS_RATIO = 1.5 # How much stripier the columns must be than the rows
+SKEW_ANGLES = [x / 4 for x in range(-20, 21)] # degrees
+MIN_SKEW = 0.5 # degrees. Less is not worth fixing
+LOSSLESS_SUFFIXES = {".png", ".gif"} # Pillow can rewrite these without losing anything
+
+
+def _ink(img):
+    """Small black and white version of img, with ink white.
+
+    The raw pixels are analysed, ignoring any EXIF orientation, since those are
+    what rotations (ours, jpegtran's and convert's) turn.
+    """
+    img = img.convert("L")
+    img.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE))
+    img = PIL.ImageOps.autocontrast(PIL.ImageOps.invert(img))
+    return img.point(lambda v: 255 if v > 128 else 0)
+
+
+def _variance(values):
+    mean = sum(values) / len(values)
+    return sum((v - mean)**2 for v in values) / len(values)
+
+
+def _row_profile(ink):
+    return list(ink.resize((1, ink.height), PIL.Image.Resampling.BOX).getdata())
+
+
+def _spread(values):
+    return _variance(values) if len(values) > 1 else float("inf")
+
+
+def _straightest(ink):
+    """The small clockwise rotation (in degrees) which makes the rows most stripey, and how stripey"""
+    best_angle, best_score = 0, _variance(_row_profile(ink))
+    for angle in SKEW_ANGLES:
+        score = _variance(_row_profile(ink.rotate(-angle, resample=PIL.Image.Resampling.BILINEAR)))
+        if score > best_score:
+            best_angle, best_score = angle, score
+    return best_angle, best_score
+
+
+def orientation(ink):
+    """Clockwise rotation (0, 90 or 270) which makes lines of text horizontal.
+
+    Upside-down text is not detected.
+    """
+    # Compare each way up at its straightest, so skewed pages aren't taken for sideways ones
+    _, upright = _straightest(ink)
+    _, sideways = _straightest(ink.rotate(90, expand=True))
+    if sideways <= SIDEWAYS_RATIO * upright:
+        return 0
+    # Lines of text run top to bottom. They start at the left margin, which is
+    # even, and end raggedly. Whichever end is even is where the left margin went.
+    pixels = ink.load()
+    starts, ends = [], []
+    for x in range(ink.width):
+        column = [y for y in range(ink.height) if pixels[x, y]]
+        if len(column) > 0:
+            starts.append(column[0])
+            ends.append(column[-1])
+    if _spread(starts) <= _spread(ends):
+        return 270 # Left margin at the top: the page was turned clockwise
+    return 90
+
+
+def skew(ink):
+    """Small clockwise rotation (in degrees) which straightens lines of text"""
+    return _straightest(ink)[0]
+
+
+def analyse(path):
+    with PIL.Image.open(path) as img:
+        ink = _ink(img)
+    rotation = orientation(ink)
+    if rotation != 0:
+        ink = ink.rotate(-rotation, expand=True)
+    return rotation, skew(ink)
+
+
+def _pillow_keep(img):
+    """Save options which carry over what else img holds, rotated to match"""
+    keep = { k: img.info[k] for k in ("exif", "icc_profile", "transparency") if k in img.info }
+    if "dpi" in img.info:
+        keep["dpi"] = tuple(reversed(img.info["dpi"])) # Turned sideways
+    if img.format == "PNG":
+        keep["pnginfo"] = PIL.PngImagePlugin.PngInfo()
+        for k, v in img.text.items():
+            keep["pnginfo"].add_text(k, v)
+    return keep
+
+
+def rotate_losslessly(path, rotation):
+    """Returns False if the image can't be rotated without losing quality"""
+    tmp_path = path.with_name(path.name + ".rotate.tmp")
+    if path.suffix.lower() in {".jpg", ".jpeg"}:
+        # -perfect fails rather than drop partial blocks at the edges
+        try:
+            done = subprocess.run(["jpegtran", "-rotate", str(rotation), "-perfect", "-copy", "all", "-outfile", tmp_path, path])
+        except FileNotFoundError: # jpegtran isn't installed
+            return False
+        if done.returncode != 0:
+            tmp_path.unlink(missing_ok=True)
+            return False
+    elif path.suffix.lower() in LOSSLESS_SUFFIXES:
+        with PIL.Image.open(path) as img:
+            if getattr(img, "n_frames", 1) > 1: # Only the first frame would be kept
+                return False
+            transpose = PIL.Image.Transpose.ROTATE_270 if rotation == 90 else PIL.Image.Transpose.ROTATE_90
+            rotated = img.transpose(transpose)
+            rotated.save(tmp_path, format=img.format, **_pillow_keep(img))
+        with PIL.Image.open(tmp_path) as saved:
+            same = recompress.same_images(rotated, saved)
+        if not same:
+            tmp_path.unlink()
+            return False
+    else: # WebP and the rest re-encode, even when told not to. Leave them to convert
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+
+def _process(path, apply):
+    """Runs in a worker process. Returns (path, signature, result). The signature is None if the result shouldn't be cached"""
+    try:
+        if not OrganizerImage(path, None, 0).match_tags(["-cleaned"]):
+            return path, file_signature(path), None
+    except (OSError, ValueError, yaml.YAMLError, UnicodeDecodeError) as e: # A broken sidecar. Try again once it's fixed
+        return path, None, { "error": "sidecar: {}".format(str(e).splitlines()[0]) }
+    try:
+        rotation, deskew = analyse(path)
+    except (OSError, ValueError) as e:
+        return path, file_signature(path), { "error": str(e).splitlines()[0] }
+    applied = False
+    if apply and rotation != 0:
+        applied = rotate_losslessly(path, rotation)
+    return path, file_signature(path), { "rotation": 0 if applied else rotation, "deskew": deskew, "applied": rotation if applied else 0 }
+
+
+def preprocess(master, apply=False, workers=None):
+    """Analyse every uncleaned image under master. Returns (images with a suggestion, images rotated, errors)"""
+    cache_path = master.joinpath(STATE_DIR, "preprocess.json")
+    cache = load_state(cache_path)
+    done = { key: entry["signature"] for key, entry in cache.items() }
+    paths = list(walk_images(master, done, leftover_suffix=".rotate.tmp"))
+
+    suggested, rotated, errors = 0, 0, []
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_process, path, apply) for path in paths]
+            for future in concurrent.futures.as_completed(futures):
+                path, signature, result = future.result()
+                if signature is not None:
+                    cache[str(path.relative_to(master))] = { "signature": signature, "result": result }
+                if result is not None and "error" in result:
+                    errors.append("{}: {}".format(path, result["error"]))
+                if result is None or "error" in result:
+                    continue
+                rotated += result["applied"] != 0
+                if result["rotation"] != 0 or abs(result["deskew"]) >= MIN_SKEW:
+                    try:
+                        image = OrganizerImage(path, None, 0)
+                    except (OSError, ValueError, yaml.YAMLError, UnicodeDecodeError) as e: # Changed since the worker read it
+                        errors.append("{}: sidecar: {}".format(path, str(e).splitlines()[0]))
+                        continue
+                    image.textfm['suggested_rotation'] = result["rotation"]
+                    image.textfm['suggested_deskew'] = result["deskew"] if abs(result["deskew"]) >= MIN_SKEW else 0
+                    image._save_text()
+                    suggested += 1
+    finally: # Keep what we have if interrupted
+        save_state(cache_path, cache)
+    return suggested, rotated, errors
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Shrink finished (+verified) scans without losing anything.
+
+By default PNGs are re-saved with the best compression, and JPEGs are optimised
+with jpegtran. Alternatively every image can be converted to another lossless
+format, such as WebP. Each new file is decoded and compared pixel for pixel with
+the original at full depth, and only replaces it if it is smaller. Animations,
+and images deeper than WebP can hold, are left alone. A converted image is put
+in place before the original is removed, and then its sidecar's `filename` is
+updated.
+
+Finished files are recorded in a journal, so an interrupted run picks up where
+it left off.
+"""
+import concurrent.futures
+import json
+import os
+import subprocess
+
+import PIL.Image
+import yaml
+
+from organize import ImageClobberingError, OrganizerImage, STATE_DIR, file_signature, walk_images
+
+TARGETS = {
+    "optimize": None, # Keep the format
+    "png": ".png",
+    "webp": ".webp",
+}
+JPEG_SUFFIXES = {".jpg", ".jpeg"}
+DEEP_MODES = {"I", "I;16", "I;16B", "I;16L", "I;16N", "F"} # More than 8 bits per channel, which WebP can't hold
+# Modes which can be converted to others without changing any pixel
+WIDER_MODES = {
+    "1": {"L", "RGB", "RGBA"},
+    "L": {"RGB", "RGBA"},
+    "LA": {"RGBA"},
+    "RGB": {"RGBA"},
+}
+STRIP_HEIGHT = 256 # rows compared at once
+
+
+def _tmp_path(path):
+    return path.with_name(path.name + ".recompress.tmp")
+
+
+def _save(path, tmp_path, target):
+    """Write a smaller version of path to tmp_path. Returns False if there's nothing to try"""
+    suffix = path.suffix.lower()
+    if target is None and suffix in JPEG_SUFFIXES:
+        subprocess.run(["jpegtran", "-optimize", "-copy", "all", "-outfile", tmp_path, path], check=True)
+        return True
+    with PIL.Image.open(path) as img:
+        if getattr(img, "n_frames", 1) > 1: # Animations would be cut to their first frame
+            return False
+        if target == ".webp" and img.mode in DEEP_MODES:
+            return False
+        keep = { k: img.info[k] for k in ("dpi", "exif", "icc_profile") if k in img.info }
+        if target == ".webp":
+            img.save(tmp_path, format="WEBP", lossless=True, quality=100, method=6, exact=True, **keep)
+        elif target == ".png" or suffix == ".png":
+            img.save(tmp_path, format="PNG", optimize=True, **keep)
+        else:
+            return False
+    return True
+
+
+def _without_palette(img):
+    if img.mode != "P": # Palettes may be reordered, so compare colours
+        return img
+    return img.convert("RGBA" if "transparency" in img.info else "RGB")
+
+
+def same_images(a, b):
+    """Whether two open images have exactly the same pixels, at full depth"""
+    if a.size != b.size or getattr(a, "n_frames", 1) != getattr(b, "n_frames", 1):
+        return False
+    a, b = _without_palette(a), _without_palette(b)
+    if a.mode != b.mode:
+        # Only ever widen. Narrowing could hide a difference
+        if b.mode in WIDER_MODES.get(a.mode, ()):
+            a = a.convert(b.mode)
+        elif a.mode in WIDER_MODES.get(b.mode, ()):
+            b = b.convert(a.mode)
+        else:
+            return False
+    for top in range(0, a.height, STRIP_HEIGHT):
+        box = (0, top, a.width, min(top + STRIP_HEIGHT, a.height))
+        if a.crop(box).tobytes() != b.crop(box).tobytes():
+            return False
+    return True
+
+
+def same_pixels(path, other_path):
+    """Whether two image files decode to exactly the same pixels, at full depth"""
+    with PIL.Image.open(path) as a, PIL.Image.open(other_path) as b:
+        return same_images(a, b)
+
+
+def _recompress(path, target):
+    """Runs in a worker process. Returns (path, temporary path or None, error or None)"""
+    tmp_path = _tmp_path(path)
+    try:
+        if not _save(path, tmp_path, target):
+            return path, None, None
+        if not same_pixels(path, tmp_path):
+            tmp_path.unlink()
+            return path, None, "pixels differ after recompressing"
+        if tmp_path.stat().st_size >= path.stat().st_size:
+            tmp_path.unlink()
+            return path, None, None
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        tmp_path.unlink(missing_ok=True)
+        return path, None, str(e).splitlines()[0]
+    return path, tmp_path, None
+
+
+def _finish_conversion(path, new_path):
+    """Remove the original, once its converted copy is in place, and point the sidecar at the copy. Safe to repeat"""
+    path.unlink(missing_ok=True)
+    OrganizerImage(new_path, None, 0)._save_text() # New filename. The sidecar's name doesn't change
+
+
+def recompress(master, target=None, workers=None):
+    """Recompress every verified image under master. Returns (images shrunk, bytes saved, errors)"""
+    journal_path = master.joinpath(STATE_DIR, "recompress.jsonl")
+    done = {} # path -> signature, for images already as small as they'll get
+    converting = {} # converted path -> original path, for conversions which may have been interrupted
+    if journal_path.exists():
+        with open(journal_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # Cut short by a crash
+                    continue
+                if "converting" in entry:
+                    converting[entry["to"]] = entry["converting"]
+                else:
+                    converting.pop(entry["path"], None)
+                    if entry["target"] == target:
+                        done[entry["path"]] = entry["signature"]
+    for new_key, key in converting.items():
+        path, new_path = master.joinpath(key), master.joinpath(new_key)
+        if new_path.exists() and (not path.exists() or same_pixels(path, new_path)):
+            _finish_conversion(path, new_path)
+
+    paths, errors = [], []
+    for path in walk_images(master, done, leftover_suffix=".recompress.tmp"):
+        try:
+            if not OrganizerImage(path, None, 0).match_tags(["+verified"]):
+                continue
+        except (OSError, ValueError, yaml.YAMLError, UnicodeDecodeError) as e:
+            errors.append("{}: sidecar: {}".format(path, str(e).splitlines()[0]))
+            continue
+        paths.append(path)
+
+    shrunk, saved = 0, 0
+    os.makedirs(journal_path.parent, exist_ok=True)
+    with open(journal_path, "a") as journal:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_recompress, path, target) for path in paths]
+            for future in concurrent.futures.as_completed(futures):
+                path, tmp_path, error = future.result()
+                if error is not None:
+                    errors.append("{}: {}".format(path, error))
+                    continue
+                if tmp_path is not None:
+                    old_size = path.stat().st_size
+                    if target is None or path.suffix.lower() == target:
+                        os.replace(tmp_path, path)
+                    else:
+                        new_path = path.with_suffix(target)
+                        if new_path.exists():
+                            tmp_path.unlink()
+                            errors.append("{}: {}".format(path, ImageClobberingError().message))
+                            continue
+                        # The original stays until its replacement is in place. If interrupted
+                        # after that, the journal says which conversion to finish
+                        journal.write(json.dumps({ "converting": str(path.relative_to(master)), "to": str(new_path.relative_to(master)) }) + "\n")
+                        journal.flush()
+                        os.replace(tmp_path, new_path)
+                        _finish_conversion(path, new_path)
+                        path = new_path
+                    shrunk += 1
+                    saved += old_size - path.stat().st_size
+                journal.write(json.dumps({ "path": str(path.relative_to(master)), "target": target, "signature": file_signature(path) }) + "\n")
+                journal.flush()
+    return shrunk, saved, errors
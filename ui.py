@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 import collections
+import concurrent.futures
 import enum
 import functools
+import io
+import math
 import os.path
 import re
+import subprocess
+import threading
 
 import natsort
 import PIL
@@ -13,6 +18,8 @@ import tkinter as tk
 import tkinter.messagebox as tkmessagebox
 import tkinter.ttk as ttk
 
+import metrics
+
 
 class ButtonActionInvalidError(BaseException):
     def __init__(self, reason):
@@ -47,39 +54,325 @@ class Ignorer():
         pass
 
 
+class HeadlessPhase(Ignorer):
+    def __init__(self, name):
+        self.id = name.replace("^", "")
+    def get_extra(self, e):
+        return Ignorer()
+
+
+class HeadlessWindow(Ignorer):
+    """Stands in for TranscriptionWindow without a display, eg for benchmarks"""
+    def add_phase(self, name, **kw_args):
+        return HeadlessPhase(name)
+
+
+MULTIPAGE_SUFFIXES = {".pdf", ".tif", ".tiff"}
+
+
+def _run_pdf_tool(command):
+    """Output of a poppler command. Raises OSError if it fails, eg on a damaged PDF"""
+    done = subprocess.run(command, capture_output=True)
+    if done.returncode != 0:
+        raise OSError("{} failed: {}".format(command[0], done.stderr.decode("utf8", "replace").strip()))
+    return done.stdout
+
+
+def page_count(path):
+    if path.suffix.lower() == ".pdf":
+        info = _run_pdf_tool(["pdfinfo", path]).decode("utf8", "replace")
+        match = re.search(r"^Pages:\s+(\d+)$", info, re.MULTILINE)
+        if match is None:
+            raise ValueError("pdfinfo found no pages in {}".format(path))
+        return int(match.group(1))
+    with PIL.Image.open(path) as img:
+        return getattr(img, "n_frames", 1)
+
+
+def open_page(path, page):
+    """Decode one page (counting from 0) of an image or multi-page document"""
+    with metrics.timed("image.decode"):
+        if path.suffix.lower() == ".pdf":
+            # Rasterize only the page we want
+            png = _run_pdf_tool(["pdftoppm", "-f", str(page+1), "-l", str(page+1), "-r", "150", "-png", "-singlefile", path])
+            img = PIL.Image.open(io.BytesIO(png))
+        else:
+            img = PIL.Image.open(path)
+            img.seek(page)
+        img.load()
+        return img
+
+
+class PageCache():
+    """Recently decoded pages, up to about max_bytes of them. Neighbouring pages
+    of documents are decoded in the background"""
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self._pages = collections.OrderedDict() # (path, mtime, page) -> Future
+        self._lock = threading.Lock() # Trimmed from the worker, too
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def get(self, path, page, page_count):
+        mtime = path.stat().st_mtime_ns # Rotating or cropping changes the file
+        future = self._page(path, mtime, page)
+        with metrics.timed("image.wait"): # Decoding is timed in the worker, off the main thread
+            img = future.result()
+        for neighbour in (page+1, page-1):
+            if 0 <= neighbour < page_count:
+                self._page(path, mtime, neighbour)
+        return img
+
+    def _page(self, path, mtime, page):
+        key = (path, mtime, page)
+        with self._lock:
+            if key in self._pages:
+                self._pages.move_to_end(key)
+                return self._pages[key]
+            future = self._pages[key] = self._executor.submit(open_page, path, page)
+        future.add_done_callback(lambda _: self._trim())
+        return future
+
+    def _trim(self):
+        """Forget the least recently used pages, until the rest fit in max_bytes. Always keeps the newest"""
+        with self._lock:
+            total = 0
+            for i, key in enumerate(reversed(list(self._pages))):
+                future = self._pages[key]
+                if i > 0 and total > self.max_bytes:
+                    del self._pages[key]
+                elif future.done() and future.exception() is None:
+                    img = future.result()
+                    total += img.width * img.height * len(img.getbands())
+
+
+TILE_SIZE = 256
+
+
+class TilePyramid():
+    """An image as a pyramid of tiles. Level n is the image shrunk by 2**n.
+
+    Levels and tiles are made on demand (usually in a worker thread), and only
+    the most recently used tiles are kept.
+    """
+    def __init__(self, img, cache_size=128):
+        if img.mode not in ("L", "RGB", "RGBA"):
+            img = img.convert("RGB")
+        self.img = img
+        self.size = img.size
+        self.cache_size = cache_size
+        self._levels = [img]
+        self._tiles = collections.OrderedDict() # (level, tx, ty, width, height) -> tile
+        self._lock = threading.Lock()
+
+    def level_for(self, scale):
+        """The smallest level with at least as much detail as scale needs"""
+        level = 0
+        while scale * 2**(level+1) <= 1 and max(self.size) >= 2**(level+1):
+            level += 1
+        return level
+
+    def level(self, n):
+        with self._lock:
+            while len(self._levels) <= n:
+                self._levels.append(self._levels[-1].reduce(2))
+            return self._levels[n]
+
+    def tile(self, level, tx, ty, width, height):
+        """Tile (tx, ty) of a level, resized to width x height"""
+        key = (level, tx, ty, width, height)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+        img = self.level(level)
+        with metrics.timed("image.tile"):
+            tile = img.crop((tx*TILE_SIZE, ty*TILE_SIZE, min((tx+1)*TILE_SIZE, img.width), min((ty+1)*TILE_SIZE, img.height)))
+            if tile.size != (width, height):
+                tile = tile.resize((width, height), PIL.Image.Resampling.LANCZOS)
+        with self._lock:
+            self._tiles[key] = tile
+            while len(self._tiles) > self.cache_size:
+                self._tiles.popitem(last=False)
+        return tile
+
+    def visible_tiles(self, scale, left, top, width, height):
+        """The tiles covering a width x height view at scale, whose top left is (left, top) in the full image.
+
+        Yields (level, tx, ty, x, y, tile width, tile height), x and y being view coordinates.
+        """
+        level = self.level_for(scale)
+        level_scale = scale * 2**level
+        level_width, level_height = math.ceil(self.size[0] / 2**level), math.ceil(self.size[1] / 2**level)
+        # Tile sizes depend only on the scale, so panning reuses tiles
+        x0, y0 = round(left / 2**level * level_scale), round(top / 2**level * level_scale)
+        def edges(t, length):
+            return round(t*TILE_SIZE*level_scale), round(min((t+1)*TILE_SIZE, length)*level_scale)
+        for ty in range(max(0, int(y0 / level_scale // TILE_SIZE)), math.ceil(level_height / TILE_SIZE)):
+            top_edge, bottom_edge = edges(ty, level_height)
+            if top_edge - y0 >= height:
+                break
+            for tx in range(max(0, int(x0 / level_scale // TILE_SIZE)), math.ceil(level_width / TILE_SIZE)):
+                left_edge, right_edge = edges(tx, level_width)
+                if left_edge - x0 >= width:
+                    break
+                yield level, tx, ty, left_edge - x0, top_edge - y0, max(right_edge - left_edge, 1), max(bottom_edge - top_edge, 1)
+
+
 class Image(tk.Canvas):
+    """Shows an image, fitted to the canvas.
+
+    Scroll to zoom, drag to pan, and double-click to fit the image again. Only
+    visible tiles are drawn, so panning around a huge scan stays fast.
+    """
+    pages = PageCache()
+    worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    MAX_SCALE = 4
+    PHOTO_CACHE_SIZE = 256
+
     def __init__(self, parent):
         super().__init__(parent)
         self.img = None
+        self.pyramid = None
+        self._pyramid_source = None
+        self._source = None # (path, page, page count) to show
+        self.visible = False
+        self.scale = None # None means fit to the canvas
+        self.left, self.top = 0, 0 # The view, in full-size image pixels
+        self._photos = collections.OrderedDict() # tile key -> PhotoImage
+        self._pending = {} # tile key -> Future
+        self._wanted = set() # Tiles in the current view. Others are skipped by the worker
+        self._collecting = False
         self.bind("<Configure>", self.resize)
-
-    def set(self, image_path):
+        self.bind("<ButtonPress-1>", self.on_drag_start)
+        self.bind("<B1-Motion>", self.on_drag)
+        self.bind("<Double-Button-1>", self.on_fit)
+        self.bind("<MouseWheel>", self.on_wheel)
+        self.bind("<Button-4>", self.on_wheel) # X11 sends scrolling as buttons 4 and 5
+        self.bind("<Button-5>", self.on_wheel)
+
+    def set(self, image_path, page=0, page_count=1):
+        self._source = None if image_path is None else (image_path, page, page_count)
+        if not self.visible: # Decoded when shown. Huge scans in every tab would use too much memory
+            return
         if image_path is None:
             self.img = None 
         else:
-            self.img = PIL.Image.open(image_path)
+            try:
+                self.img = self.pages.get(image_path, page, page_count)
+            except (OSError, ValueError): # Damaged. Show nothing, rather than stop working
+                self.img = None
         self.update_image(self.img)
+
+    def set_visible(self, visible):
+        """Let go of the image while hidden, and get it back when shown"""
+        self.visible = visible
+        if visible:
+            self.set(*(self._source or (None,)))
+        else:
+            self.img, self._pyramid_source = None, None
+            self.update_image(None)
+            self._photos.clear()
+            self._pending.clear()
     
     def update_image(self, img, width=None, height=None):
         if width is None:
             width, height = self.winfo_width(), self.winfo_height()
+        self._width, self._height = width, height
         if img is None:
-            self.delete("all")
-            return
+            self.pyramid = None
+        elif self.pyramid is None or self._pyramid_source is not img:
+            self._pyramid_source = img
+            self.pyramid = TilePyramid(img)
+            self.scale = None
+            self.left, self.top = 0, 0
+            self._photos.clear()
+            self._pending.clear()
+        self.render()
 
-        # Keep aspect ratio
-        img_width, img_height = img.size
-        ratio = min(width*1.0/img_width, height*1.0/img_height)
-        width, height = max(int(img_width*ratio),1), max(int(img_height*ratio),1)
+    def resize(self, event):
+        self.update_image(self.img, width=event.width, height=event.height)
 
-        self.pi = PIL.ImageTk.PhotoImage(img.resize(
-            (width, height), PIL.Image.Resampling.LANCZOS
-        ))
+    def fit_scale(self):
+        img_width, img_height = self.pyramid.size
+        return min(self._width*1.0/img_width, self._height*1.0/img_height)
+
+    def render(self):
         self.delete("all")
-        self.create_image(0, 0, anchor=tk.NW, image=self.pi) 
+        if self.pyramid is None:
+            return
+        scale = self.fit_scale() if self.scale is None else self.scale
+        pyramid = self.pyramid
+        wanted = set()
+        for level, tx, ty, x, y, width, height in pyramid.visible_tiles(scale, self.left, self.top, self._width, self._height):
+            key = (level, tx, ty, width, height)
+            wanted.add(key)
+            if key in self._photos:
+                self._photos.move_to_end(key)
+                self.create_image(x, y, anchor=tk.NW, image=self._photos[key])
+            elif key not in self._pending:
+                self._pending[key] = self.worker.submit(self._make_tile, pyramid, key)
+        self._wanted = wanted
+        while len(self._photos) > self.PHOTO_CACHE_SIZE:
+            self._photos.popitem(last=False)
+        if len(self._pending) > 0 and not self._collecting:
+            self._collecting = True
+            self.after(15, self._collect)
+
+    def _make_tile(self, pyramid, key):
+        """Runs in the worker thread"""
+        if pyramid is not self.pyramid or key not in self._wanted:
+            return None # Scrolled or zoomed past it already
+        return pyramid.tile(*key)
+
+    def _collect(self):
+        """Draw tiles the worker has finished"""
+        self._collecting = False
+        done = [key for key, future in self._pending.items() if future.done()]
+        for key in done:
+            tile = self._pending.pop(key).result()
+            if tile is not None:
+                self._photos[key] = PIL.ImageTk.PhotoImage(tile) # Only the main thread may touch Tk
+        if len(done) > 0:
+            self.render()
+        elif len(self._pending) > 0:
+            self._collecting = True
+            self.after(15, self._collect)
+
+    def _clamp(self):
+        img_width, img_height = self.pyramid.size
+        self.left = max(0, min(self.left, img_width - self._width / self.scale))
+        self.top = max(0, min(self.top, img_height - self._height / self.scale))
+
+    def on_wheel(self, event):
+        if self.pyramid is None:
+            return
+        zoom_in = event.num == 4 or event.delta > 0
+        scale = self.fit_scale() if self.scale is None else self.scale
+        new_scale = min(scale * (1.25 if zoom_in else 0.8), self.MAX_SCALE)
+        if new_scale <= self.fit_scale():
+            return self.on_fit(event)
+        # Keep the point under the mouse still
+        x, y = self.left + event.x / scale, self.top + event.y / scale
+        self.scale = new_scale
+        self.left, self.top = x - event.x / new_scale, y - event.y / new_scale
+        self._clamp()
+        self.render()
+
+    def on_drag_start(self, event):
+        self._drag_start = (event.x, event.y, self.left, self.top)
+
+    def on_drag(self, event):
+        if self.pyramid is None or self.scale is None:
+            return
+        x, y, left, top = self._drag_start
+        self.left, self.top = left - (event.x - x) / self.scale, top - (event.y - y) / self.scale
+        self._clamp()
+        self.render()
 
-    def resize(self, event):
-        self.update_image(self.img, width=event.width, height=event.height)
+    def on_fit(self, event):
+        self.scale = None
+        self.left, self.top = 0, 0
+        self.render()
 
 
 class TranscriptionWindow(tk.Tk):
@@ -101,6 +394,7 @@ class TranscriptionWindow(tk.Tk):
         phase = TranscriptionPhase(self.tabControl, name=name, **kw_args)
         self.tabControl.add(phase, text=name, underline=shortcut_index)
         self.phases.append(phase)
+        phase.set_visible(len(self.phases) == 1) # The first tab is selected to begin with
         return phase
     
     def select_phase(self, phase):
@@ -110,6 +404,9 @@ class TranscriptionWindow(tk.Tk):
     def on_tab_change(self, event):
         active_tab = self.tabControl.index("current")
         phase = self.phases[active_tab]
+        metrics.set_phase(phase.id)
+        for other in self.phases:
+            other.set_visible(other is phase)
         phase.focus_set()
         phase.refresh()
 
@@ -117,6 +414,8 @@ class TranscriptionWindow(tk.Tk):
         excluded = (ExtraTranscribe, tk.Entry,)
         active_tab = self.tabControl.index("current")
         phase = self.phases[active_tab]
+        if event.keysym in ("Prior", "Next"): # Flip pages even while typing a transcription
+            return phase.handle_keypress(event)
         if isinstance(event.widget, excluded) and event.state == 0:
             return
         return phase.handle_keypress(event)
@@ -141,6 +440,7 @@ class TranscriptionPhase(tk.Frame):
         self.finished = 0
         self.skipped = 0
         self.current_image = None
+        self.page = 0 # For multi-page documents
 
         # self.photo_frame      self.extras_frame
         # +-------------------+ +-----------------------------+
@@ -161,6 +461,7 @@ class TranscriptionPhase(tk.Frame):
         self.sv_current_image_path = tk.StringVar(self, "Loading...")
         self.sv_current_image_name = tk.StringVar(self, "Loading...")
         self.sv_progress = tk.StringVar(self, "Loading...")
+        self.sv_page = tk.StringVar(self, "")
 
         # "Flex" rows that take up extra space
         # self.frame layout
@@ -193,6 +494,8 @@ class TranscriptionPhase(tk.Frame):
         # |                   |
         # |    image_canvas   |
         # |                   |
+        # +-------------------|
+        # |    label (page)   |
         # +-------------------+
         self.photo_frame.grid_columnconfigure(1, weight=1) # allocate extra space to row 3 and column 1
         self.photo_frame.grid_rowconfigure(3, weight=1)
@@ -202,6 +505,8 @@ class TranscriptionPhase(tk.Frame):
         self.lbl_progress.grid(column=1, row=2)
         self.image_canvas = Image(self.photo_frame)
         self.image_canvas.grid(column=1, row=3, rowspan=2, sticky=tk.W+tk.N+tk.E+tk.S)
+        self.lbl_page = tk.Label(self.photo_frame, textvariable=self.sv_page, padx=20, pady=0)
+        self.lbl_page.grid(column=1, row=5)
 
         # self.extras_frame
         self.extras = {}
@@ -261,12 +566,17 @@ class TranscriptionPhase(tk.Frame):
 
     def handle_keypress(self, event):
         state, key = event.state, event.keysym
+        if key in ("Prior", "Next"): # Page Up/Down, wherever the focus is
+            self.set_page(self.page + (1 if key == "Next" else -1))
+            return
         actions = self.shortcuts.get((None, key))
         actions = self.shortcuts.get((state, key), actions)
         if actions is not None:
             self._handle_button(actions, event)
 
     def _handle_button(self, actions, event):
+        if self.current_image is None: # Still loading, or nothing left to do
+            return
         if not isinstance(actions, list):
             actions = [actions]
         for action in actions:
@@ -276,6 +586,9 @@ class TranscriptionPhase(tk.Frame):
                 tkmessagebox.showinfo(message=e.message)
                 return
     
+    def set_visible(self, visible):
+        self.image_canvas.set_visible(visible)
+
     def refresh(self):
         if self.current_image is not None:
             self.set_image(*self._refresh_args)
@@ -287,6 +600,8 @@ class TranscriptionPhase(tk.Frame):
         return self.extras.get(e, Ignorer()) # Magic so we don't have to check for None
 
     def set_image(self, image, is_work, categories, recent_categories):
+        if image is not self.current_image:
+            self.page = 0
         self.current_image = image
         self._refresh_args = (image, is_work, categories, recent_categories)
         if self.current_image is None:
@@ -297,29 +612,42 @@ class TranscriptionPhase(tk.Frame):
             self.get_extra(Extras.METADATA_DISPLAY).set_metadata("")
             self.get_extra(Extras.RENAME).set_name("")
             self.get_extra(Extras.SHOW_CATEGORY).set_category(None)
-            self.get_extra(Extras.TRANSCRIBE).set_transcription("")
+            self.get_extra(Extras.TRANSCRIBE).set_transcription([""])
+            self.sv_page.set("")
         else:
-            self.image_canvas.set(self.current_image.image_path)
+            self.page = min(self.page, image.page_count - 1)
+            self.image_canvas.set(self.current_image.image_path, self.page, image.page_count)
             self.sv_current_image_path.set(str(self.current_image.image_path))
             self.sv_current_image_name.set(self.current_image.image_path)
             self.get_extra(Extras.CATEGORY_PICKER).set_category(image.category, categories, recent_categories, image.category is not None)
             self.get_extra(Extras.METADATA_DISPLAY).set_metadata(image.metadata_string)
             self.get_extra(Extras.RENAME).set_name(image.image_path.stem)
             self.get_extra(Extras.SHOW_CATEGORY).set_category(image.category)
-            self.get_extra(Extras.TRANSCRIBE).set_transcription(image.transcription)
+            self.get_extra(Extras.TRANSCRIBE).set_transcription(image.page_transcriptions)
+            self._show_page()
 
-    def increment_todo(self, amount=1):
-        self.todo += amount
-        self.update_progress()
+    def set_page(self, page):
+        image = self.current_image
+        if image is None or not 0 <= page < image.page_count:
+            return
+        self.page = page
+        self.image_canvas.set(image.image_path, page, image.page_count)
+        self._show_page()
+
+    def _show_page(self):
+        self.get_extra(Extras.TRANSCRIBE).show_page(self.page)
+        if self.current_image.page_count > 1:
+            self.sv_page.set("Page {} of {} (PgUp/PgDn)".format(self.page + 1, self.current_image.page_count))
+        else:
+            self.sv_page.set("")
 
-    def increment_skipped(self, amount=1):
-        self.skipped += amount
-        self.update_progress()
-            
-    def increment_finished(self, amount=1):
-        self.finished += amount
+    def set_progress(self, todo, finished, skipped):
+        self.todo, self.finished, self.skipped = todo, finished, skipped
         self.update_progress()
 
+    def set_loading(self, status):
+        self.sv_progress.set(status)
+
     def set_done(self, done, popup=False):
         if done:
             self.set_image(None, False, [], [])
@@ -339,10 +667,59 @@ class Extra():
         return tk.W+tk.N+tk.E+tk.S
 
 
+def _is_subsequence(letters, text):
+    rest = iter(text)
+    return all(letter in rest for letter in letters)
+
+
+class CategoryIndex():
+    """Categories in display order (recent ones first), with a search index"""
+    def __init__(self, categories, recent_categories, shortcut_keys):
+        rows = natsort.natsorted([(category not in recent_categories, category.name, category) for category in categories])
+        self.categories = []
+        self.labels = []
+        self.shortcuts = {}
+        for i, (not_recent, category_name, category) in enumerate(rows):
+            self.categories.append(category)
+            if not not_recent:
+                self.shortcuts[shortcut_keys[i]] = category
+                self.labels.append("({}) {}".format(shortcut_keys[i], category_name))
+            else:
+                self.labels.append(category_name)
+        self._names = [category.name.lower() for category in self.categories]
+        self._letters = [frozenset(name) for name in self._names]
+        self._last_query, self._last_matches = "", list(range(len(self.categories)))
+
+    def filter(self, query):
+        """Rows matching query, in display order. Rows containing each word come
+        before rows which merely contain the letters in order."""
+        query = query.strip().lower()
+        if query == "":
+            return list(range(len(self.categories)))
+        # Typing more can only narrow down the last search
+        candidates = range(len(self.categories))
+        if self._last_query != "" and query.startswith(self._last_query):
+            candidates = self._last_matches
+        words, letters = query.split(), query.replace(" ", "")
+        letter_set = set(letters)
+        matches, fuzzy_matches = [], []
+        for row in candidates:
+            if not letter_set <= self._letters[row]:
+                continue
+            name = self._names[row]
+            if all(word in name for word in words):
+                matches.append(row)
+            elif _is_subsequence(letters, name):
+                fuzzy_matches.append(row)
+        self._last_query, self._last_matches = query, sorted(matches + fuzzy_matches)
+        return matches + fuzzy_matches
+
+
 class ExtraCategoryPicker(tk.Frame, Extra, EventHaver):
     """Category picker.
 
-    Displays a list of possible categories, and allows selecting one.
+    Displays a list of possible categories, and allows selecting one. Typing
+    in the box above the list narrows it down.
     Allows making a new category.
     If a category is selected, displays information about that category.
 
@@ -353,14 +730,26 @@ class ExtraCategoryPicker(tk.Frame, Extra, EventHaver):
         EventHaver.__init__(self)
 
         self.SHORTCUTS = "1234567890"
+        self.get_categories = get_categories
         self.choices = tk.StringVar(value=[])
         self.filenames = tk.StringVar(value=[])
         self.sv_new_category = tk.StringVar(value="")
-        self._categories = []
+        self.sv_filter = tk.StringVar(value="")
+        self.index = CategoryIndex([], [], self.SHORTCUTS)
+        self.shortcuts = {}
+        self._index_key = None # Rebuild the index only when this changes
+        self._rows = None # Rows of the index being shown
+        self._categories = [] # Categories being shown
+        self._positions = {} # category -> position in the listbox
 
         self.grid_rowconfigure(1, weight=1)
         self.grid_columnconfigure(1, weight=1)
 
+        self.filter_box = tk.Entry(self, textvariable=self.sv_filter)
+        self.filter_box.grid(column=1, row=0, columnspan=2, sticky=tk.W+tk.E)
+        self.filter_box.bind("<Return>", self.on_filter_return)
+        self.filter_box.bind("<Down>", lambda event: self.listbox.focus_set())
+        self.sv_filter.trace_add("write", self.on_filter_changed)
         self.listbox = tk.Listbox(self, listvariable=self.choices)
         self.listbox.grid(column=1, row=1, columnspan=2, sticky=tk.W+tk.N+tk.E+tk.S)
         self.listbox2 = tk.Listbox(self, listvariable=self.filenames, state=tk.DISABLED)
@@ -384,33 +773,54 @@ class ExtraCategoryPicker(tk.Frame, Extra, EventHaver):
         if key not in self.shortcuts:
             return
         category = self.shortcuts[key]
-        self.set_category(category, self._categories, self._recent_categories)
+        self.set_category(category, self._all_categories, self._recent_categories)
         self.listbox.xview_moveto(0)
 
     def set_category(self, active_category, categories, recent_categories, show=True):
-        self._recent_categories = [x for x in recent_categories]
-        _categories = natsort.natsorted([(category not in self._recent_categories, category.name, category) for category in categories])
-        self.shortcuts = {}
-        self._categories = []
-        choices = []
-        for i, (not_recent, category_name, category) in enumerate(_categories):
-            is_recent = not not_recent
-            self._categories.append(category)
-            if is_recent:
-                self.shortcuts[self.SHORTCUTS[i]] = category
-                choices.append("({}) {}".format(self.SHORTCUTS[i], category_name))
-            else:
-                choices.append(category_name)
-        self.choices.set(choices)
+        recent_categories = [x for x in recent_categories]
+        key = (id(categories), getattr(categories, "version", None), tuple(recent_categories))
+        if key != self._index_key:
+            self._index_key = key
+            self._all_categories, self._recent_categories = categories, recent_categories
+            self.index = CategoryIndex(categories, recent_categories, self.SHORTCUTS)
+            self.shortcuts = self.index.shortcuts
+            self._rows = None
+        if self.sv_filter.get() != "":
+            self.sv_filter.set("") # Calls on_filter_changed
+        else:
+            self._show_rows(self.index.filter(""))
 
         self.listbox.select_clear(0, "end")
         if active_category is not None:
-            index = self._categories.index(active_category)
+            index = self._positions[active_category]
             self.listbox.selection_set((index,))
             if show:
                 self.listbox.see(index)
         self.on_category_changed()
 
+    def _show_rows(self, rows):
+        if rows == self._rows:
+            return
+        self._rows = rows
+        self._categories = [self.index.categories[row] for row in rows]
+        self._positions = { category: i for i, category in enumerate(self._categories) }
+        self.choices.set([self.index.labels[row] for row in rows])
+
+    def on_filter_changed(self, *args):
+        selected_category = self.selected_category
+        self._show_rows(self.index.filter(self.sv_filter.get()))
+        self.listbox.select_clear(0, "end")
+        if selected_category in self._positions:
+            self.listbox.selection_set((self._positions[selected_category],))
+        self.listbox.see(0)
+
+    def on_filter_return(self, event):
+        """Pick the best match"""
+        if len(self._categories) > 0:
+            self.listbox.select_clear(0, "end")
+            self.listbox.selection_set((0,))
+            self.on_category_changed()
+
     def get_category(self):
         if len(self.listbox.curselection()) == 1:
             index = self.listbox.curselection()[0]
@@ -425,8 +835,9 @@ class ExtraCategoryPicker(tk.Frame, Extra, EventHaver):
         # If the category is unset, don't reset the textbox
         if selected_category is not None:
             self._last_selected_category = selected_category
-            filenames = [file.name for file in selected_category.path.iterdir() if file.suffix != ".txt"]
-            self.filenames.set(natsort.natsorted(filenames))
+            with metrics.timed("list_category"):
+                filenames = [file.name for file in selected_category.path.iterdir() if file.suffix != ".txt"]
+                self.filenames.set(natsort.natsorted(filenames))
             self.sv_new_category.set(selected_category.name)
 
     @property
@@ -494,8 +905,9 @@ class ExtraShowCategory(tk.Frame, Extra, EventHaver):
 
         self.listbox.select_clear(0, "end")
         if category is not None:
-            filenames = [file.name for file in category.path.iterdir() if file.suffix != ".txt"]
-            self.filenames.set(natsort.natsorted(filenames))
+            with metrics.timed("list_category"):
+                filenames = [file.name for file in category.path.iterdir() if file.suffix != ".txt"]
+                self.filenames.set(natsort.natsorted(filenames))
 
     def click_file(self, event):
         selected_index, = self.listbox.curselection()
@@ -533,16 +945,29 @@ class ExtraRename(tk.Frame, Extra):
 class ExtraTranscribe(tk.Text, Extra):
     """Transcription window
 
-    Loaded with any existing transcription.
+    Loaded with any existing transcription, one page at a time.
 
-    Does not save transcribed content automatically.
+    Does not save transcribed content automatically, but remembers edits when
+    switching pages.
     """
     def __init__(self, root):
         super().__init__(root)
+        self._pages = [""]
+        self._page = 0
+
+    def set_transcription(self, pages):
+        self._pages = list(pages)
+        self._page = 0
+        self.delete("1.0", tk.END)
+        self.insert("1.0", self._pages[0])
 
-    def set_transcription(self, transcription):
+    def show_page(self, page):
+        self._pages[self._page] = self.get("1.0", "end-1c")
+        self._page = page
         self.delete("1.0", tk.END)
-        self.insert("1.0", transcription)
+        self.insert("1.0", self._pages[page])
 
     def get_transcription(self):
-        return self.get("1.0", tk.END)
+        """Returns the transcription of each page"""
+        self._pages[self._page] = self.get("1.0", tk.END)
+        return list(self._pages)